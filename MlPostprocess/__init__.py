@@ -2,26 +2,29 @@ import logging
 
 import azure.functions as func
 
-import sys
 import os
 import cv2
-import argparse
 import json
 import numpy as np
 from osgeo import gdal, osr
-import torch
-from PIL import Image
-# add local 'external components' path to sys.path for import
-local_libs = os.getcwd()
-sys.path.append(os.path.join(local_libs, "external"))
 
+from shared_code import anomalies as anomaly_columns
 
+# root of the downloaded ODM tasks, one folder per uuid
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
 MOSAIC_META = "mosaics.json"
-ANOMALY_META = "anomalies.json"
+ANOMALY_META = "anomalies.bin"
+ANOMALY_JSON = "anomalies.json"
+ANOMALY_GEOJSON = "anomalies.geojson"
+# additionally export the anomalies in the nested JSON layout for external consumers
+ANOMALY_JSON_EXPORT = os.environ.get('ANOMALY_JSON_EXPORT', '0') == '1'
 ORTHOPHOTO_PATTERN = '*.tif'
 PATCH_SIZE_HEIGHT = 512
 PATCH_SIZE_WIDTH = 640
 PATCHES_FOLDER = 'patches'
+RESULT_SUFFIX = '-result.tif'
+# size of the windows the result is rendered in, a multiple of the COG block size
+RENDER_WINDOW_SIZE = 2048
 
 
 def main(msg: func.QueueMessage, msgout: func.Out[func.QueueMessage]) -> None:
@@ -30,7 +33,7 @@ def main(msg: func.QueueMessage, msgout: func.Out[func.QueueMessage]) -> None:
 
     uuid = msg.get_body().decode('utf-8')
 
-    dir = os.path.join('/datashare/downloads', uuid, 'odm_orthophoto')
+    dir = os.path.join(DOWNLOADS_FOLDER, uuid, 'odm_orthophoto')
 
     orthophoto = os.path.join(dir, "odm_orthophoto.tif")
 
@@ -58,130 +61,238 @@ def compute_colors_for_labels(labels, palette=None):
     Simple function that adds fixed colors depending on the class
     """
     if palette is None:
-        palette = torch.tensor([2 ** 25 - 1, 2 ** 15 - 1, 2 ** 21 - 1])
-    colors = labels[:, None] * palette
-    colors = (colors % 255).numpy().astype("uint8")
+        palette = np.array([2 ** 25 - 1, 2 ** 15 - 1, 2 ** 21 - 1], dtype=np.int64)
+    colors = np.asarray(labels, dtype=np.int64)[:, None] * palette
+    colors = (colors % 255).astype("uint8")
     return colors
 
 
 def load_meta_data(folder, meta_fn):
+    """
+    Loads JSON meta data, or the memory-mapped columns of a columnar anomalies file.
+    """
     meta_fn = os.path.join(folder, meta_fn)
     meta = None
     if os.path.exists(meta_fn):
+        if meta_fn.endswith('.bin'):
+            return anomaly_columns.load_anomalies(meta_fn)
         with open(meta_fn, "r") as f:
             meta = json.load(f)
     return meta
 
 
 def merge_anomalies(mosaic_meta, anomalie_meta):
-    boxes, classes, scores, contours, centers = [], [], [], [], []
+    """
+    Maps the anomalies of all patches into mosaic coordinates, in the order of the
+    patches in the mosaic meta data. The patch offsets are added to all boxes, centers
+    and contour points of a patch in one array operation.
+    """
+    if anomalie_meta is None or len(anomalie_meta['patch_names']) == 0:
+        return anomaly_columns.empty_anomalies()
+
+    patch_index = {name: k for k, name in enumerate(anomalie_meta['patch_names'])}
+    patches, shifts = [], []
     for mosaic in mosaic_meta:
         for patch in mosaic_meta[mosaic]:
-            if patch['patch_name'] in anomalie_meta:
-                a = anomalie_meta[patch['patch_name']]
-                # map patch coordinates into mosaic coordinates
-                for box in a['boxes']:
-                    box[0] += patch['x']
-                    box[1] += patch['y']
-                    box[2] += patch['x']
-                    box[3] += patch['y']
-                for contour in a['contours']:
-                    c = contour[0]
-                    for p in c:
-                        p[0][0] += patch['x']
-                        p[0][1] += patch['y']
-                for center in a['centers']:
-                    center[0] += patch['x']
-                    center[1] += patch['y']
-                boxes += a['boxes']
-                classes += a['classes']
-                scores += a['scores']
-                contours += a['contours']
-                centers += a['centers']
-
-    anomalies = {
-        'boxes': boxes,
-        'classes': classes,
-        'scores': scores,
-        'contours': contours,
-        'centers': centers,
-    }
-    return anomalies
+            if patch.get('skipped', False):
+                continue
+            if patch['patch_name'] in patch_index:
+                patches.append(patch_index[patch['patch_name']])
+                shifts.append((patch['x'], patch['y']))
 
+    # detections of the patches and the offset of their patch, one per detection
+    patch_offsets = anomalie_meta['patch_offsets']
+    patches = np.asarray(patches, dtype=np.int64)
+    counts = patch_offsets[patches + 1] - patch_offsets[patches]
+    detections = anomaly_columns.gather_ranges(patch_offsets[patches], counts)
+    shifts = np.repeat(np.asarray(shifts, dtype=np.int32).reshape(-1, 2), counts, axis=0)
 
-def save_anomalies(folder, anomalies):
-    class NumpyEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, np.ndarray):
-                return obj.tolist()
-            return json.JSONEncoder.default(self, obj)
+    return anomaly_columns.select_detections(anomalie_meta, detections, shifts)
 
-    with open(os.path.join(folder, ANOMALY_META), 'w') as m:
-        m.write(json.dumps(anomalies, indent=4, cls=NumpyEncoder))
 
+def save_anomalies(folder, anomalies):
+    anomaly_columns.save_anomalies(os.path.join(folder, ANOMALY_META), anomalies)
+    if ANOMALY_JSON_EXPORT:
+        anomaly_columns.export_json(os.path.join(folder, ANOMALY_JSON), anomalies)
 
-def mark_anomalies(image_name, anomalies):
-    image = Image.open(image_name).convert('RGB')
-    image = np.array(image)
 
+def render_anomalies(image, anomalies, origin=(0, 0), detections=None):
+    """
+    Draws the contours, labels and centers of the anomalies into a BGR image, which is
+    the window of the mosaic starting at origin. Each contour border is blended only
+    within its bounding region, so the cost depends on the anomalies, not on the image size.
+    If detections are given, only those anomalies are drawn.
+    """
+    ox, oy = origin
+    height, width = image.shape[:2]
     scores = anomalies['scores']
-    boxes = torch.IntTensor(anomalies['boxes'])
-    contours = anomalies["contours"]
-    labels = torch.IntTensor(anomalies["classes"])
-    centers = anomalies["centers"]
-
-    colors = compute_colors_for_labels(labels).tolist()
-
-    for nr, (contour, color, box, score, label, center) in enumerate(zip(contours, colors, boxes, scores, labels, centers)):
-        original = image.copy()
-
-        if len(contour) == 1:
-
-            contour1 = np.array(contour)
-
-            # add mask to image with transparent overlay
-            # overlay = cv2.fillPoly(image, contour1, color)
-            # alpha = 0.2
-            # image = cv2.addWeighted(overlay, alpha, original, 1 - alpha, 0)
-            # draw contour around mask
-            border = cv2.drawContours(image, contour1, -1, (255, 255, 0), 1)
+    labels = anomalies['classes']
+    centers = anomalies['centers']
+
+    for nr in (range(len(scores)) if detections is None else detections):
+        nr = int(nr)
+        contours = anomaly_columns.detection_contours(anomalies, nr)
+        if len(contours) != 1:
+            continue
+
+        contour = (contours[0] - np.array([ox, oy], dtype=np.int32)).astype(np.int32)
+        x, y, w, h = cv2.boundingRect(contour)
+        s = f"{nr} ({labels[nr]}: {scores[nr]:.2f})"
+        (tw, th), baseline = cv2.getTextSize(s, cv2.FONT_HERSHEY_SIMPLEX, .3, 1)
+        cx, cy = int(centers[nr][0]) - ox, int(centers[nr][1]) - oy
+        # skip anomalies whose border, label and center are all outside of the window
+        left, top = min(x, x - 2, cx - 1), min(y, y - 2 - th, cy - 1)
+        right, bottom = max(x + w, x - 2 + tw, cx + 2), max(y + h, y - 2 + baseline, cy + 2)
+        if right <= 0 or bottom <= 0 or left >= width or top >= height:
+            continue
+
+        # draw contour around mask, blended with the original within the bounding region
+        x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, width), min(y + h, height)
+        if x0 < x1 and y0 < y1:
+            original = image[y0:y1, x0:x1].copy()
+            border = cv2.drawContours(original.copy(), [contour], -1, (0, 255, 255), 1, offset=(-x0, -y0))
             alpha = 0.8
-            image = cv2.addWeighted(border, alpha, original, 1 - alpha, 0)
-
-            # box = box.to(torch.int64)
-            # top_left, bottom_right = box[:2].tolist(), box[2:].tolist()
-            # image = cv2.rectangle(
-            #     image, tuple(top_left), tuple(bottom_right), tuple(color), 1
-            # )
+            image[y0:y1, x0:x1] = cv2.addWeighted(border, alpha, original, 1 - alpha, 0)
 
-            # add bounding box
-            x, y, w, h = cv2.boundingRect(contour1[0])
-            # cv2.rectangle(image, (x, y), (x + w, y + h), color, 1)
+        # add class label and probability
+        cv2.putText(image, s, (x - 2, y - 2), cv2.FONT_HERSHEY_SIMPLEX, .3, (255, 255, 255), 1)
 
-            # add class label and probability
-            s = f"{nr} ({label}: {score:.2f})"
-            # x, y = box[:2]
-            cv2.putText(image, s, (int(x) - 2, int(y) - 2), cv2.FONT_HERSHEY_SIMPLEX, .3, (255, 255, 255), 1)
+        # add centers
+        cv2.circle(image, (cx, cy), radius=1, color=(0, 0, 255), thickness=-1)
 
-            # add centers
-            cv2.circle(image, center, radius=1, color=(255, 0, 0), thickness=-1)
+    return image
 
-    result = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-    image_folder, image_fn = os.path.split(image_name)
-    cv2.imwrite(os.path.join(image_folder, image_fn + '-result.jpg'), result)
-    print("")
 
+def render_extents(anomalies):
+    """
+    Region (left, top, right, bottom) each anomaly may draw into, enclosing its contour,
+    label and center, computed for all anomalies at once. Anomalies render_anomalies
+    does not draw, the ones without exactly one contour, get an empty region.
+    """
+    n = len(anomalies['scores'])
+    extents = np.zeros((n, 4), dtype=np.int64)
+    if n == 0 or len(anomalies['points']) == 0:
+        return extents
+    contour_offsets, point_offsets = anomalies['contour_offsets'], anomalies['point_offsets']
+    points = np.asarray(anomalies['points'], dtype=np.int64).reshape(-1, 2)
+
+    # bounds of every non-empty contour; empty ones between them add no points
+    starts = point_offsets[:-1]
+    filled = np.flatnonzero(point_offsets[1:] > starts)
+    bounds = np.zeros((len(starts), 4), dtype=np.int64)
+    if len(filled) > 0:
+        bounds[filled, :2] = np.minimum.reduceat(points, starts[filled], axis=0)
+        bounds[filled, 2:] = np.maximum.reduceat(points, starts[filled], axis=0) + 1
+    drawn = (contour_offsets[1:] - contour_offsets[:-1]) == 1
+    contour = bounds[np.where(drawn, contour_offsets[:-1], 0)]
+
+    # largest label of this set of anomalies, as formatted by render_anomalies
+    label = f"{n - 1} ({int(np.max(anomalies['classes']))}: 0.00)"
+    (tw, th), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, .3, 1)
+    centers = np.asarray(anomalies['centers'], dtype=np.int64).reshape(-1, 2)
+    # one pixel more on every side for the line thickness
+    extents[:, 0] = np.minimum(contour[:, 0] - 2, centers[:, 0] - 1) - 1
+    extents[:, 1] = np.minimum(contour[:, 1] - 2 - th, centers[:, 1] - 1) - 1
+    extents[:, 2] = np.maximum(np.maximum(contour[:, 2], contour[:, 0] - 2 + tw), centers[:, 0] + 2) + 1
+    extents[:, 3] = np.maximum(np.maximum(contour[:, 3], contour[:, 1] - 2 + baseline), centers[:, 1] + 2) + 1
+    extents[~drawn] = 0
+    return extents
+
+
+def window_anomalies(extents, width, height, size):
+    """
+    Bins the anomalies by their render extents into the render windows (size x size,
+    row by row) they intersect. Returns the indices of the anomalies of every window.
+    """
+    cols, rows = -(-width // size), -(-height // size)
+    visible = np.flatnonzero((extents[:, 2] > np.maximum(extents[:, 0], 0)) &
+                             (extents[:, 3] > np.maximum(extents[:, 1], 0)) &
+                             (extents[:, 0] < width) & (extents[:, 1] < height))
+    extents = extents[visible]
+    x0 = np.clip(extents[:, 0] // size, 0, cols - 1)
+    y0 = np.clip(extents[:, 1] // size, 0, rows - 1)
+    x1 = np.clip((extents[:, 2] - 1) // size, 0, cols - 1)
+    y1 = np.clip((extents[:, 3] - 1) // size, 0, rows - 1)
+
+    # one entry per anomaly and window it spans, most anomalies span one window
+    nx = x1 - x0 + 1
+    counts = nx * (y1 - y0 + 1)
+    entry = np.repeat(np.arange(len(visible)), counts)
+    k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    windows = (y0[entry] + k // nx[entry]) * cols + x0[entry] + k % nx[entry]
+
+    order = np.argsort(windows, kind='stable')
+    bounds = np.searchsorted(windows[order], np.arange(cols * rows + 1))
+    detections = visible[entry[order]]
+    return [detections[bounds[i]:bounds[i + 1]] for i in range(cols * rows)]
 
-def add_gps_coords(file_name, anomalies):
 
-    def get_coord_transform_gps():
-        # get the existing coordinate system
-        old_cs = osr.SpatialReference()
-        old_cs.ImportFromWkt(tif.GetProjectionRef())
+def mark_anomalies(image_name, anomalies):
+    """
+    Writes the orthophoto with the anomalies drawn on it as tiled, JPEG compressed
+    Cloud-Optimized GeoTIFF with overviews and the georeferencing of the orthophoto.
+    The result is rendered window by window, so the full raster is never in memory, and
+    each window only draws the anomalies binned to it, exactly as on the full image.
+    Returns the file name of the result.
+    """
+    src = gdal.Open(image_name)
+    width, height = src.RasterXSize, src.RasterYSize
+    # same channel layout as cv2.imread: first three bands as BGR, grey images replicated
+    bands = [3, 2, 1] if src.RasterCount >= 3 else [1, 1, 1]
+    mask_band = src.GetRasterBand(1).GetMaskBand()
+    has_mask = not src.GetRasterBand(1).GetMaskFlags() & gdal.GMF_ALL_VALID
 
-        # create the new coordinate system (WGS84)
-        wgs84_wkt = """
+    image_folder, image_fn = os.path.split(image_name)
+    result_name = os.path.join(image_folder, image_fn + RESULT_SUFFIX)
+    # not *.tif, so a leftover of an interrupted run is never taken for an orthophoto
+    tmp_name = result_name + '.tmp'
+
+    # tiled intermediate, the COG driver needs a complete source to build the overviews
+    tmp = gdal.GetDriverByName('GTiff').Create(
+        tmp_name, width, height, 4 if has_mask else 3, gdal.GDT_Byte,
+        options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    tmp.SetGeoTransform(src.GetGeoTransform())
+    tmp.SetProjection(src.GetProjectionRef())
+    if has_mask:
+        tmp.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    size = RENDER_WINDOW_SIZE
+    extents = render_extents(anomalies)
+    windows = iter(window_anomalies(extents, width, height, size))
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            w, h = min(size, width - x), min(size, height - y)
+            detections = next(windows)
+            # the window grown to the extents of its anomalies: OpenCV draws a contour cut
+            # at the edge differently, so every contour is drawn whole, then cropped
+            x0, y0, x1, y1 = x, y, x + w, y + h
+            if len(detections) > 0:
+                x0 = max(min(x0, int(extents[detections, 0].min())), 0)
+                y0 = max(min(y0, int(extents[detections, 1].min())), 0)
+                x1 = min(max(x1, int(extents[detections, 2].max())), width)
+                y1 = min(max(y1, int(extents[detections, 3].max())), height)
+            region = np.dstack([src.GetRasterBand(b).ReadAsArray(x0, y0, x1 - x0, y1 - y0) for b in bands])
+            region = render_anomalies(np.ascontiguousarray(region), anomalies, origin=(x0, y0),
+                                      detections=detections)
+            window = region[y - y0:y - y0 + h, x - x0:x - x0 + w]
+            # BGR window into RGB bands
+            for band in range(3):
+                tmp.GetRasterBand(band + 1).WriteArray(window[:, :, 2 - band], x, y)
+            if has_mask:
+                tmp.GetRasterBand(4).WriteArray(mask_band.ReadAsArray(x, y, w, h), x, y)
+
+    tmp.FlushCache()
+    # with JPEG compression the COG driver turns the alpha band into a mask
+    gdal.Translate(result_name, tmp, format='COG',
+                   creationOptions=['COMPRESS=JPEG', 'QUALITY=85', 'OVERVIEWS=AUTO', 'RESAMPLING=AVERAGE',
+                                    'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'])
+    tmp = None
+    gdal.GetDriverByName('GTiff').Delete(tmp_name)
+    return result_name
+
+
+# WGS84 as used for the GPS coordinates of the anomalies
+WGS84_WKT = """
         GEOGCS["WGS 84",
             DATUM["WGS_1984",
                 SPHEROID["WGS 84",6378137,298.257223563,
@@ -192,38 +303,113 @@ def add_gps_coords(file_name, anomalies):
             UNIT["degree",0.01745329251994328,
                 AUTHORITY["EPSG","9122"]],
             AUTHORITY["EPSG","4326"]]"""
+
+# transformations to WGS84 by projection WKT of the orthophoto: (transform, lat_first)
+_gps_transforms = {}
+
+
+def get_coord_transform_gps(projection):
+    """
+    Returns the cached transformation from the orthophoto projection to WGS84 and whether
+    it returns latitude first (GDAL 3 follows the EPSG axis order of WGS84).
+    """
+    if projection not in _gps_transforms:
+        # get the existing coordinate system
+        old_cs = osr.SpatialReference()
+        old_cs.ImportFromWkt(projection)
+
+        # create the new coordinate system (WGS84)
         new_cs = osr.SpatialReference()
-        new_cs.ImportFromWkt(wgs84_wkt)
+        new_cs.ImportFromWkt(WGS84_WKT)
 
         # create a transform object to convert between coordinate systems
         transform = osr.CoordinateTransformation(old_cs, new_cs)
-        return transform
+        lat_first = int(gdal.VersionInfo()) >= 3000000 and bool(new_cs.EPSGTreatsAsLatLong())
+        _gps_transforms[projection] = (transform, lat_first)
+    return _gps_transforms[projection]
+
 
-    def pixel_to_coord(gt, p):
-        # coefficients from geo transform of GeoTIFF
-        x_min, x_size = gt[0], gt[1]
-        y_min, y_size = gt[3], gt[5]
-        # coord in map units, convert to world coord
-        px = p[0] * x_size + x_min  # x pixel
-        py = p[1] * y_size + y_min  # y pixel
-        return [px, py]
+def pixel_to_coord(gt, pixels):
+    """
+    Maps pixel positions (n, 2) to map coordinates with the geo transform of the GeoTIFF.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+    px, py = pixels[:, 0], pixels[:, 1]
+    return np.stack([gt[0] + px * gt[1] + py * gt[2],
+                     gt[3] + px * gt[4] + py * gt[5]], axis=1)
 
+
+def add_gps_coords(file_name, anomalies):
+    """
+    Adds WGS84 coordinates of the centers (latlong), box corners (box_latlong) and
+    contour points (point_latlong) of the anomalies, in the axis order of the
+    transformation (lat, long with GDAL 3). All positions are transformed in one call.
+    """
     tif = gdal.Open(file_name)
     gt = tif.GetGeoTransform()
-    transform = get_coord_transform_gps()
+    transform, lat_first = get_coord_transform_gps(tif.GetProjectionRef())
+
+    centers = np.asarray(anomalies['centers']).reshape(-1, 2)
+    corners = np.asarray(anomalies['boxes']).reshape(-1, 2)
+    points = np.asarray(anomalies['points']).reshape(-1, 2)
+    if len(centers) == 0:
+        return anomalies
 
-    latlongs = []
-    for center in anomalies['centers']:
-        pixel = pixel_to_coord(gt, center)
-        latlong = transform.TransformPoint(pixel[0], pixel[1])
-        latlongs.append(latlong)
+    coords = pixel_to_coord(gt, np.concatenate([centers, corners, points]))
+    latlongs = np.array(transform.TransformPoints(coords.tolist()), dtype=np.float64).reshape(len(coords), -1)
 
-    if len(latlongs) > 0:
-        anomalies['latlong'] = latlongs
+    n, m = len(centers), len(centers) + len(corners)
+    anomalies['latlong'] = latlongs[:n]
+    anomalies['box_latlong'] = latlongs[n:m, :2].reshape(-1, 4)
+    anomalies['point_latlong'] = latlongs[m:, :2]
+    anomalies['lat_first'] = lat_first
 
     return anomalies
 
 
+def anomalies_to_geojson(anomalies):
+    """
+    Returns the anomalies as GeoJSON FeatureCollection in WGS84 (long, lat): the outline of
+    each anomaly as polygon from its largest contour, or its center point if the contour
+    is degenerate.
+    """
+    features = []
+    if 'latlong' not in anomalies:
+        return {'type': 'FeatureCollection', 'features': features}
+
+    # GeoJSON positions are long, lat
+    order = [1, 0] if anomalies['lat_first'] else [0, 1]
+    centers = anomalies['latlong'][:, order]
+    corners = anomalies['box_latlong'].reshape(-1, 2, 2)[:, :, order]
+    points = anomalies['point_latlong'][:, order]
+    contour_offsets, point_offsets = anomalies['contour_offsets'], anomalies['point_offsets']
+
+    for nr in range(len(centers)):
+        contours = range(contour_offsets[nr], contour_offsets[nr + 1])
+        largest = max(contours, key=lambda c: point_offsets[c + 1] - point_offsets[c], default=None)
+        geometry = {'type': 'Point', 'coordinates': centers[nr].tolist()}
+        if largest is not None and point_offsets[largest + 1] - point_offsets[largest] >= 3:
+            ring = points[point_offsets[largest]:point_offsets[largest + 1]].tolist()
+            geometry = {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+        features.append({
+            'type': 'Feature',
+            'id': nr,
+            'bbox': np.concatenate([corners[nr].min(axis=0), corners[nr].max(axis=0)]).tolist(),
+            'geometry': geometry,
+            'properties': {
+                'class': int(anomalies['classes'][nr]),
+                'score': float(anomalies['scores'][nr]),
+                'center': centers[nr].tolist(),
+            },
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def save_geojson(folder, anomalies):
+    with open(os.path.join(folder, ANOMALY_GEOJSON), 'w') as m:
+        m.write(json.dumps(anomalies_to_geojson(anomalies)))
+
+
 def post_process(file_name):
     folder, name = os.path.split(file_name)
     mosaic_meta = load_meta_data(folder, MOSAIC_META)
@@ -231,5 +417,6 @@ def post_process(file_name):
     anomalies = merge_anomalies(mosaic_meta, anomaly_meta)
     anomalies = add_gps_coords(file_name, anomalies)
     save_anomalies(folder, anomalies)
+    save_geojson(folder, anomalies)
     mark_anomalies(file_name, anomalies)
     return len(anomalies['classes'])
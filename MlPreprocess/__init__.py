@@ -4,37 +4,70 @@ import azure.functions as func
 
 import fnmatch
 import os
+import typing
 import cv2
-import argparse
 import json
 import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osgeo import gdal
 
+from shared_code.manifest import file_hash, hash_array, load_manifest, save_manifest, write_json
+from shared_code.patch_shard import PATCH_SHARD_SUFFIX, PatchShardWriter, encode_patch
+from shared_code.process_shards import PROCESS_SHARDS_FOLDER, shard_messages
+
+# root of the downloaded ODM tasks, one folder per uuid
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
 MOSAIC_META = "mosaics.json"
 ORTHOPHOTO_PATTERN = '*.tif'
+# annotated result GeoTIFF written by MlPostprocess, not an orthophoto
+RESULT_PATTERN = '*-result.tif'
 PATCH_SIZE_HEIGHT = 512
 PATCH_SIZE_WIDTH = 640
 PATCHES_FOLDER = 'patches'
+# results of MlProcess in the patches folder, kept so unchanged patches are not detected again
+ANOMALY_META = "anomalies.bin"
+# patches with a smaller fraction of valid (non nodata, non padding) pixels are skipped
+PATCH_MIN_COVERAGE = float(os.environ.get('PATCH_MIN_COVERAGE', '0.01'))
+# number of worker processes encoding patches, 0 or 1 encodes in the function process
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', '0'))
+# patches handed to the workers but not yet written, per worker
+PREPROCESS_QUEUE_PER_WORKER = 2
+# 'png' writes one file per patch, 'shard' packs all patches of an orthophoto into one file
+PATCH_STORE = os.environ.get('PATCH_STORE', 'png')
+# patches per process-queue message, larger jobs are split into shards processed in parallel;
+# 0 sends the whole job as one message
+PROCESS_SHARD_PATCHES = int(os.environ.get('PROCESS_SHARD_PATCHES', '200'))
 
 
-def main(msg: func.QueueMessage, msgout: func.Out[func.QueueMessage]) -> None:
+def main(msg: func.QueueMessage, msgout: func.Out[typing.List[str]]) -> None:
     logging.info('Python queue trigger function processed a queue item: %s',
                  msg.get_body().decode('utf-8'))
     uuid = msg.get_body().decode('utf-8')
 
-    dir = os.path.join('/datashare/downloads', uuid, 'odm_orthophoto')
+    dir = os.path.join(DOWNLOADS_FOLDER, uuid, 'odm_orthophoto')
     orthophotos = os.listdir(dir)
-    orthophotos = [f for f in orthophotos if fnmatch.fnmatch(f, ORTHOPHOTO_PATTERN)]
+    orthophotos = [f for f in orthophotos if fnmatch.fnmatch(f, ORTHOPHOTO_PATTERN)
+                   and not fnmatch.fnmatch(f, RESULT_PATTERN)]
+    mosaics_meta = {}
     if len(orthophotos) > 0:
-        split_orthophotos(dir, orthophotos)
+        mosaics_meta = split_orthophotos(dir, orthophotos)
     
-    logging.info('Preprocessing done')
-    msgout.set(uuid)
+    # shard results of earlier, unfinished runs
+    shutil.rmtree(os.path.join(dir, PATCHES_FOLDER, PROCESS_SHARDS_FOLDER), ignore_errors=True)
+    num_patches = sum(1 for mosaic in mosaics_meta.values() for patch in mosaic if not patch.get('skipped', False))
+    messages = shard_messages(uuid, num_patches, PROCESS_SHARD_PATCHES)
+    logging.info('Preprocessing done, %d patches in %d process messages', num_patches, len(messages))
+    msgout.set(messages)
     
 
 
 
-def cleanup_folder(folder):
+def cleanup_folder(folder, keep=()):
     for filename in os.listdir(folder):
+        if filename in keep:
+            continue
         file_path = os.path.join(folder, filename)
         try:
             if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -45,59 +78,199 @@ def cleanup_folder(folder):
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-def split_orthophoto(file_name):
-
-    image = cv2.imread(file_name)
-    height, width, channels = image.shape
+def read_patch_rows(file_name):
+    """
+    Reads the orthophoto row by row of patches using windowed GDAL reads, so only
+    one row of patches (PATCH_SIZE_HEIGHT x image width) is held in memory at a time.
+    Yields (y, row, valid) with row as BGR uint8 array, padded at the right/bottom edges,
+    and valid as boolean coverage mask taken from the alpha band or nodata value.
+    Padded pixels are never valid.
+    """
+    tif = gdal.Open(file_name)
+    width, height = tif.RasterXSize, tif.RasterYSize
+    # same channel layout as cv2.imread: first three bands as BGR, grey images replicated
+    bands = [3, 2, 1] if tif.RasterCount >= 3 else [1, 1, 1]
+    # GDAL mask band covers both the alpha band and the nodata value of the orthophoto
+    mask_band = tif.GetRasterBand(1).GetMaskBand()
+    all_valid = tif.GetRasterBand(1).GetMaskFlags() & gdal.GMF_ALL_VALID
 
     pad_h = height - PATCH_SIZE_HEIGHT * (height // PATCH_SIZE_HEIGHT)
     pad_w = width - PATCH_SIZE_WIDTH * (width // PATCH_SIZE_WIDTH)
+    padded_height, padded_width = height + pad_h, width + pad_w
 
-    # first pad image to multiples of PATCH_SIZE_WIDTHxPATCH_SIZE_HEIGHT
-    padded = cv2.copyMakeBorder(image, 0, pad_h, 0, pad_w, cv2.BORDER_CONSTANT, 0)
-    padded_height, padded_width, padded_channels = padded.shape
+    # only whole patches are cut from the padded image
+    h, w = PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH
+    row_width = padded_width - padded_width % w
+    read_width = min(width, row_width)
 
-    # cv2.imwrite(f'{file_name}-padded.tif', padded)
+    y = 0
+    while y+h <= padded_height:
+        rows = min(h, height - y)
+        # edge rows/columns stay zero, which equals the constant border padding
+        row = np.zeros((h, row_width, 3), dtype=np.uint8)
+        for channel, band in enumerate(bands):
+            row[:rows, :read_width, channel] = tif.GetRasterBand(band).ReadAsArray(0, y, read_width, rows)
+        valid = np.zeros((h, row_width), dtype=bool)
+        if all_valid:
+            valid[:rows, :read_width] = True
+        else:
+            valid[:rows, :read_width] = mask_band.ReadAsArray(0, y, read_width, rows) > 0
+        yield y, row, valid
+        y += h
+
+
+def write_patch(patch_name, patch):
+    cv2.imwrite(patch_name, patch)
+
+
+def split_orthophoto(file_name, min_coverage=PATCH_MIN_COVERAGE, pool=None, max_pending=0, store=PATCH_STORE):
+    """
+    Splits the orthophoto into patches and returns the mosaic meta data of its patches.
+    If a process pool is given, the PNG encoding is fanned out to it, with at most
+    max_pending patches in flight so memory stays bounded. The mosaic meta data is
+    built in grid order either way.
+    With store 'shard' all patches are appended to one shard file in the patches
+    folder and the mosaic meta data records shard, offset and length of every patch.
+    """
 
     mosaic_data = []
+    pending = deque()
+
+    folder, name = os.path.split(file_name)
+    shard = None
+    if store == 'shard':
+        shard_name = name + PATCH_SHARD_SUFFIX
+        shard = PatchShardWriter(os.path.join(folder, PATCHES_FOLDER, shard_name))
+
+    def finish(patch, data):
+        if shard is not None:
+            patch['shard'] = shard_name
+            patch['offset'], patch['length'] = shard.append(data)
 
-    x = y = 0
     h, w = PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH
     i = 0
 
-    while y+h <= padded_height:
-        while x+w <= padded_width:
-            p = padded[y:y+h, x:x+w]
-            i += 1
-            patch_name = f'{file_name}-patch{i}.png'
-            folder, name = os.path.split(patch_name)
-            patch_name = os.path.join(folder, PATCHES_FOLDER, name)
-            cv2.imwrite(patch_name, p)
-            mosaic_data.append({
-                "patch_name": f'{name}',
-                "x": x,
-                "y": y,
-            })
-            x += w
-        x = 0
-        y += h
+    try:
+        for y, row, valid in read_patch_rows(file_name):
+            x = 0
+            while x+w <= row.shape[1]:
+                p = row[:, x:x+w]
+                coverage = float(np.count_nonzero(valid[:, x:x+w])) / (h * w)
+                i += 1
+                patch_name = f'{file_name}-patch{i}.png'
+                folder, name = os.path.split(patch_name)
+                patch_name = os.path.join(folder, PATCHES_FOLDER, name)
+                patch = {
+                    "patch_name": f'{name}',
+                    "x": x,
+                    "y": y,
+                    "coverage": round(coverage, 4),
+                }
+                if coverage < min_coverage or coverage == 0:
+                    # empty or nodata patch: not written, so it never reaches detection
+                    patch["skipped"] = True
+                else:
+                    # content hash, MlProcess reuses the results of unchanged patches
+                    patch["hash"] = hash_array(p)
+                    job, args = (write_patch, (patch_name, p)) if shard is None else (encode_patch, (p,))
+                    if pool is None:
+                        finish(patch, job(*args))
+                    else:
+                        pending.append((patch, pool.submit(job, *args)))
+                        while len(pending) > max_pending:
+                            done, future = pending.popleft()
+                            finish(done, future.result())
+                mosaic_data.append(patch)
+                x += w
+
+        # wait for outstanding writes, re-raising encoding errors
+        while pending:
+            done, future = pending.popleft()
+            finish(done, future.result())
+    finally:
+        if shard is not None:
+            shard.close()
 
     return mosaic_data
 
 
+def preprocess_inputs(folder, file_names, manifest):
+    """
+    Everything the patches depend on: the content of the orthophotos and the patch parameters.
+    """
+    return {
+        'orthophotos': {name: file_hash(os.path.join(folder, name), manifest) for name in sorted(file_names)},
+        'params': {
+            'patch_height': PATCH_SIZE_HEIGHT,
+            'patch_width': PATCH_SIZE_WIDTH,
+            'min_coverage': PATCH_MIN_COVERAGE,
+            'store': PATCH_STORE,
+        },
+    }
+
+
+def load_previous_patches(folder, manifest, inputs):
+    """
+    Returns the mosaic meta data of the previous run if it was made from the same inputs
+    and all its patches are still there, otherwise None.
+    """
+    mosaic_meta_fn = os.path.join(folder, MOSAIC_META)
+    if manifest.get('preprocess', {}).get('inputs') != inputs or not os.path.exists(mosaic_meta_fn):
+        return None
+    with open(mosaic_meta_fn, 'r') as f:
+        mosaics_meta = json.load(f)
+    if sorted(mosaics_meta) != sorted(inputs['orthophotos']):
+        return None
+
+    patches_folder = os.path.join(folder, PATCHES_FOLDER)
+    for mosaic in mosaics_meta.values():
+        for patch in mosaic:
+            if patch.get('skipped', False):
+                continue
+            if 'hash' not in patch:
+                return None
+            if 'shard' in patch:
+                shard_name = os.path.join(patches_folder, patch['shard'])
+                if not os.path.exists(shard_name) or os.path.getsize(shard_name) < patch['offset'] + patch['length']:
+                    return None
+            elif not os.path.exists(os.path.join(patches_folder, patch['patch_name'])):
+                return None
+    return mosaics_meta
+
+
 def split_orthophotos(folder, file_names):
+    manifest = load_manifest(folder)
+    inputs = preprocess_inputs(folder, file_names, manifest)
+    mosaics_meta = load_previous_patches(folder, manifest, inputs)
+    if mosaics_meta is not None:
+        logging.info('Orthophotos and patch parameters unchanged, keeping the patches')
+        save_manifest(folder, manifest)
+        return mosaics_meta
+
+    # the patches are replaced, a failure on the way must not leave them marked as current
+    manifest.pop('preprocess', None)
+    save_manifest(folder, manifest)
+
     def init_patches_folder(folder):
         patches_folder = f'{folder}/{PATCHES_FOLDER}'
         if not os.path.exists(patches_folder):
             os.makedirs(patches_folder)
         else:
-            cleanup_folder(patches_folder)
+            cleanup_folder(patches_folder, keep=(ANOMALY_META,))
     init_patches_folder(folder)
     mosaics_meta = {}
-    for file_name in file_names:
-        mosaics_meta[file_name] = split_orthophoto(os.path.join(folder, file_name))
-    with open(os.path.join(folder, MOSAIC_META), 'w') as m:
-        m.write(json.dumps(mosaics_meta, indent=4))
+    if PREPROCESS_WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS) as pool:
+            for file_name in file_names:
+                mosaics_meta[file_name] = split_orthophoto(
+                    os.path.join(folder, file_name), pool=pool,
+                    max_pending=PREPROCESS_WORKERS * PREPROCESS_QUEUE_PER_WORKER)
+    else:
+        for file_name in file_names:
+            mosaics_meta[file_name] = split_orthophoto(os.path.join(folder, file_name))
+    write_json(os.path.join(folder, MOSAIC_META), mosaics_meta, indent=4)
+    manifest['preprocess'] = {'inputs': inputs}
+    save_manifest(folder, manifest)
     # return amount of files processed
     return mosaics_meta
 
@@ -2,39 +2,73 @@ import logging
 
 import azure.functions as func
 
-import argparse
-import sys
 import os
 import fnmatch
+import shutil
+import threading
+import time
 from PIL import Image
 import json
 
-# add local 'external components' path to sys.path for import
-local_libs = os.getcwd()
-sys.path.append(os.path.join(local_libs, "external"))
-
-import albumentations as A
-import albumentations.pytorch.transforms as PA
 import torch
+from torch.utils.data import DataLoader, Dataset
 #import myutils
 import cv2
 import numpy as np
 
+from shared_code import anomalies as anomaly_columns
+from shared_code.manifest import file_hash, load_manifest, save_manifest
+from shared_code.process_shards import FAN_IN_MARKER, PROCESS_SHARDS_FOLDER, parse_message, shard_file
+from shared_code.patch_shard import PatchShardReader
+
+from .engine import engine_file, load_engine
+
+# root of the downloaded ODM tasks, one folder per uuid
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
+MOSAIC_META = "mosaics.json"
 PATCHES_FOLDER = 'patches'
-ANOMALY_META = "anomalies.json"
+ANOMALY_META = "anomalies.bin"
+ANOMALY_JSON = "anomalies.json"
+# additionally export the anomalies in the nested JSON layout for external consumers
+ANOMALY_JSON_EXPORT = os.environ.get('ANOMALY_JSON_EXPORT', '0') == '1'
 FILE_PATTERN = "*.png"
+MODEL_NAME = os.environ.get('MODEL_NAME', os.path.join("/datashare/model", "sunshaine.model"))
+# load the model and run a dummy forward pass when the function host starts
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '0') == '1'
+PATCH_SIZE_HEIGHT = 512
+PATCH_SIZE_WIDTH = 640
+# 'eager' runs the pickled model, 'torchscript', 'onnx' and 'quantized' the exported model (see engine.py)
+INFERENCE_ENGINE = os.environ.get('INFERENCE_ENGINE', 'eager')
+# CPU thread pools of the inference engine, 0 keeps the library default
+INFERENCE_INTRA_OP_THREADS = int(os.environ.get('INFERENCE_INTRA_OP_THREADS', '0'))
+INFERENCE_INTER_OP_THREADS = int(os.environ.get('INFERENCE_INTER_OP_THREADS', '0'))
+# patches per forward pass
+INFERENCE_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', '4'))
+# background processes decoding and transforming the next batches, 0 loads in the function process
+INFERENCE_LOADER_WORKERS = int(os.environ.get('INFERENCE_LOADER_WORKERS', '2'))
+# part of the key of cached anomalies, raised when the stored detections change
+# 2: boxes as int32 pixels, they were wrapped to 8 bit before
+DETECTION_VERSION = 2
 
 def main(msg: func.QueueMessage, msgout: func.Out[func.QueueMessage]) -> None:
     logging.info('Python queue trigger function processed a queue item: %s',
                  msg.get_body().decode('utf-8'))
 
-    uuid = msg.get_body().decode('utf-8')
+    job = parse_message(msg.get_body().decode('utf-8'))
+    uuid = job['uuid']
 
-    dir = os.path.join('/datashare/downloads', uuid, 'odm_orthophoto')
+    dir = os.path.join(DOWNLOADS_FOLDER, uuid, 'odm_orthophoto')
 
+    if 'shard' in job:
+        # only the shard completing the job passes it on to postprocessing
+        if detect_shard(os.path.join(dir, PATCHES_FOLDER), MODEL_NAME, 0.75, job):
+            logging.info('All %d shards done', job['shards'])
+            msgout.set(uuid)
+        else:
+            logging.info('Shard %d of %d done', job['shard'] + 1, job['shards'])
+        return
 
-    model_name = os.path.join("/datashare/model", "sunshaine.model")
-    num_patches = detect(os.path.join(dir, PATCHES_FOLDER), model_name, 0.75)
+    num_patches = detect(os.path.join(dir, PATCHES_FOLDER), MODEL_NAME, 0.75)
 
 
     logging.info('Processing done. num_patches=' + str(num_patches))
@@ -52,72 +86,350 @@ def get_cuda_device():
     return device
 
 
-def center_from_contours(contours):
+# models loaded by this worker process, by (path, engine): ((mtime, size), model)
+_models = {}
+_models_lock = threading.Lock()
+
+
+def load_model(model_name, engine=INFERENCE_ENGINE):
+    """
+    Returns the model for the inference engine from the process-wide cache. The model
+    file is only read again if its modification time or size changed since it was loaded.
+    """
+    file_name = engine_file(model_name, engine)
+    stat = os.stat(file_name)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _models_lock:
+        cached = _models.get((model_name, engine))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        logging.info('Loading model %s', file_name)
+        model = load_engine(model_name, engine, INFERENCE_INTRA_OP_THREADS, INFERENCE_INTER_OP_THREADS,
+                            device=get_cuda_device())
+        _models[(model_name, engine)] = (version, model)
+        return model
+
+
+# sha256 of the model files by path, computed once per worker process: (mtime, size), entry
+_model_hashes = {}
+
+
+def model_hash(file_name):
+    """
+    Returns the manifest entry (size, modification time, sha256) of the model file from
+    the process-wide cache, so jobs and shards do not hash the model over the share.
+    """
+    stat = os.stat(file_name)
+    version = (stat.st_mtime_ns, stat.st_size)
+    key = os.path.abspath(file_name)
+    with _models_lock:
+        cached = _model_hashes.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    files = {}
+    file_hash(file_name, {'files': files})
+    with _models_lock:
+        _model_hashes[key] = (version, files[key])
+    return files[key]
+
+
+def warm_up_model(model_name, engine=INFERENCE_ENGINE):
+    """
+    Loads the model into the cache and runs a forward pass on an empty patch, so the
+    first job does not pay for loading and lazy initialisation.
+    """
+    model = load_model(model_name, engine)
+    with torch.no_grad():
+        model([torch.zeros(3, PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH, device=model.device)])
+    logging.info('Model %s warmed up', model_name)
+
+
+def mask_roi(box, height, width):
+    """
+    Region of the mask to search for the contour: the detection's box plus a margin,
+    as Mask R-CNN pastes masks slightly beyond the box. Returns (x0, y0, x1, y1).
+    """
+    x0, y0, x1, y1 = [float(v) for v in box]
+    mx, my = 0.05 * (x1 - x0) + 2, 0.05 * (y1 - y0) + 2
+    x0, y0 = max(int(x0 - mx), 0), max(int(y0 - my), 0)
+    x1, y1 = min(int(np.ceil(x1 + mx)), width), min(int(np.ceil(y1 + my)), height)
+    return x0, y0, max(x1, x0), max(y1, y0)
+
+
+def binary_roi(mask, box=None):
+    """
+    Thresholds the region of the mask (1, H, W) around the detection's box, the whole
+    mask without a box. Returns the region as uint8 array and its origin x, y.
+    """
+    height, width = mask.shape[-2:]
+    x0, y0, x1, y1 = (0, 0, width, height) if box is None else mask_roi(box, height, width)
+    return np.ascontiguousarray(mask[0, y0:y1, x0:x1].ge(0.5).byte().cpu().numpy()), x0, y0
+
+
+def center_from_masks(masks, boxes):
+    """
+    Centers of the binary masks from their moments m10/m00 and m01/m00, computed within
+    the region of each detection's box only. Empty masks (m00 == 0) get the center of
+    their box.
+    """
+    boxes = boxes.detach().cpu().numpy()
     centers = []
-    for contour in contours:
-        c = max(contour, key=len)
-        M = cv2.moments(c)
-        print(M)
-        cx = int(M['m10'] / M['m00'])
-        cy = int(M['m01'] / M['m00'])
-        centers.append((cx, cy))
+    for mask, box in zip(masks, boxes):
+        roi, x0, y0 = binary_roi(mask, box)
+        M = cv2.moments(roi, binaryImage=True)
+        if M['m00'] == 0:
+            centers.append((int((box[0] + box[2]) / 2), int((box[1] + box[3]) / 2)))
+        else:
+            centers.append((int(x0 + M['m10'] / M['m00']), int(y0 + M['m01'] / M['m00'])))
     return centers
 
 
-def masks_to_contour(masks):
+def masks_to_contour(masks, boxes=None):
+    """
+    Finds the contours of the binary masks. If the detection boxes are given, only the
+    region of each box is thresholded and searched; contour points are in patch
+    coordinates either way.
+    """
+    boxes = None if boxes is None else boxes.detach().cpu().numpy()
     contours = []
-    masks = masks.ge(0.5).mul(255).byte().cpu().numpy()
-    for mask in masks:
-        ret, thresh = cv2.threshold(mask[0], 127, 255, 0)
-        c, h = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    for nr, mask in enumerate(masks):
+        roi, x0, y0 = binary_roi(mask, None if boxes is None else boxes[nr])
+        c, h = cv2.findContours(roi, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
         contours.append(c)
     return contours
 
 
-def detect(folder, model_name, confidentiality=0.5):
-
-    model = torch.load(model_name, map_location=torch.device('cpu'))
-    model.eval()
-
-    device = get_cuda_device()
-    model.to(device)
-
-    # --------------------
-
-    transforms = A.Compose([
+def list_patches(folder):
+    """
+    Returns the mosaic meta data entries of all patches to process, the patches not
+    skipped in mosaics.json next to the patches folder. Without mosaics.json the PNG
+    patches in the folder are listed.
+    """
+    mosaic_meta_fn = os.path.join(os.path.dirname(os.path.normpath(folder)), MOSAIC_META)
+    if os.path.exists(mosaic_meta_fn):
+        with open(mosaic_meta_fn, "r") as f:
+            mosaic_meta = json.load(f)
+        return [patch for mosaic in mosaic_meta.values() for patch in mosaic if not patch.get('skipped', False)]
+
+    return [{'patch_name': name} for name in os.listdir(folder)
+            if os.path.isfile(os.path.join(folder, name))
+            and fnmatch.fnmatch(name, FILE_PATTERN)]
+
+
+def read_patch(folder, patch, shards):
+    """
+    Loads a patch as RGB array, either from its PNG file or with a ranged read from its
+    shard. Opened shard readers are kept in shards for the following patches.
+    """
+    if 'shard' in patch:
+        if patch['shard'] not in shards:
+            shards[patch['shard']] = PatchShardReader(os.path.join(folder, patch['shard']))
+        image = shards[patch['shard']].read_patch(patch['offset'], patch['length'])
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return np.array(Image.open(os.path.join(folder, patch['patch_name'])).convert('RGB'))
+
+
+class PatchDataset(Dataset):
+    """
+    Decodes and transforms patches for the inference data loader. Shard readers are
+    opened lazily, so every loader worker process gets its own.
+    """
+
+    def __init__(self, folder, patches, transforms):
+        self.folder = folder
+        self.patches = patches
+        self.transforms = transforms
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.patches)
+
+    def __getitem__(self, idx):
+        patch = self.patches[idx]
+        img = read_patch(self.folder, patch, self.shards)
+        return patch['patch_name'], self.transforms(image=img)['image']
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+
+def patch_transforms():
+    # albumentations pulls in scipy and scikit-image, only imported once patches are processed
+    import albumentations as A
+    import albumentations.pytorch.transforms as PA
+    return A.Compose([
         A.ToGray(p=1),
         A.ToFloat(max_value=255),
         PA.ToTensorV2(),
     ])
 
-    image_files = [name for name in os.listdir(folder)
-                   if os.path.isfile(os.path.join(folder, name))
-                   and fnmatch.fnmatch(name, FILE_PATTERN)]
 
-    anomalies = {}
+def collate_patches(batch):
+    names, images = zip(*batch)
+    return list(names), list(images)
+
+
+def load_cached_anomalies(folder, previous, key, patches):
+    """
+    Splits the patches into the ones whose anomalies are known from the previous run,
+    with the same model, engine, threshold and detection version and the same patch
+    content, and the ones to detect. Returns the known anomalies by patch name and the
+    patches to detect.
+    """
+    anomaly_meta_fn = os.path.join(folder, ANOMALY_META)
+    if previous.get('key') != key or not os.path.exists(anomaly_meta_fn):
+        return {}, patches
+    data = anomaly_columns.load_anomalies(anomaly_meta_fn)
+    offsets = data['patch_offsets']
+    patch_index = {name: k for k, name in enumerate(data['patch_names'])}
+
+    known, todo = {}, []
+    for patch in patches:
+        name = previous['patches'].get(patch.get('hash'))
+        if name is None:
+            todo.append(patch)
+        elif name in patch_index:
+            # detections are in patch coordinates, so they hold for any patch with this content
+            k = patch_index[name]
+            known[patch['patch_name']] = anomaly_columns.unpack_detections(data, offsets[k], offsets[k + 1])
+    return known, todo
+
+
+def detect_anomalies(folder, model_name, confidentiality, batch_size, num_workers, engine, start=0, end=None):
+    """
+    Detects the anomalies of the patches start:end and returns them packed into columns,
+    together with the manifest entries describing them.
+    """
+    patches = list_patches(folder)[start:end]
+    manifest = load_manifest(os.path.dirname(os.path.normpath(folder)))
+    model_file = engine_file(model_name, engine)
+    model_entry = model_hash(model_file)
+    key = {
+        'model': model_entry['sha256'],
+        'engine': engine,
+        'threshold': confidentiality,
+        'version': DETECTION_VERSION,
+    }
+    anomalies, todo = load_cached_anomalies(folder, manifest.get('process', {}), key, patches)
+    logging.info('%d of %d patches unchanged since the last run', len(patches) - len(todo), len(patches))
+    if len(todo) > 0:
+        anomalies.update(detect_patches(folder, todo, model_name, confidentiality, batch_size, num_workers, engine))
+
+    # keep the order of the patches, independent of which ones were detected again
+    data = anomaly_columns.pack_anomalies({patch['patch_name']: anomalies[patch['patch_name']]
+                                           for patch in patches if patch['patch_name'] in anomalies})
+    record = {
+        'files': {os.path.abspath(model_file): model_entry},
+        'process': {
+            'key': key,
+            'patches': {patch['hash']: patch['patch_name'] for patch in patches if 'hash' in patch},
+        },
+    }
+    return data, record
+
+
+def update_manifest(folder, record):
+    job_folder = os.path.dirname(os.path.normpath(folder))
+    manifest = load_manifest(job_folder)
+    manifest.setdefault('files', {}).update(record['files'])
+    manifest['process'] = record['process']
+    save_manifest(job_folder, manifest)
+
+
+def detect(folder, model_name, confidentiality=0.5, batch_size=INFERENCE_BATCH_SIZE,
+           num_workers=INFERENCE_LOADER_WORKERS, engine=INFERENCE_ENGINE):
+
+    data, record = detect_anomalies(folder, model_name, confidentiality, batch_size, num_workers, engine)
+    save_anomalies(folder, data)
+    update_manifest(folder, record)
+
+    return len(data['patch_names'])
+
+
+def detect_shard(folder, model_name, confidentiality, job, batch_size=INFERENCE_BATCH_SIZE,
+                 num_workers=INFERENCE_LOADER_WORKERS, engine=INFERENCE_ENGINE):
+    """
+    Detects the anomalies of the patches of one shard of a job and stores them with the
+    results of the other shards. Returns True for the one shard that found all shards
+    done and merged their results, False otherwise.
+    """
+    data, record = detect_anomalies(folder, model_name, confidentiality, batch_size, num_workers, engine,
+                                    job['start'], job['end'])
+    shards_folder = os.path.join(folder, PROCESS_SHARDS_FOLDER, job['run'])
+    os.makedirs(shards_folder, exist_ok=True)
+    data['manifest'] = record
+    anomaly_columns.save_anomalies(os.path.join(shards_folder, shard_file(job['shard'])), data)
+    return fan_in(folder, job)
+
+
+def fan_in(folder, job):
+    """
+    Merges the results of all shards of the job into the anomalies of the job, once all
+    are there. Every shard checks after writing its result, so the last one to finish
+    sees all; the marker file is created exclusively, so only one shard merges.
+    """
+    shards_folder = os.path.join(folder, PROCESS_SHARDS_FOLDER, job['run'])
+    shard_files = [os.path.join(shards_folder, shard_file(k)) for k in range(job['shards'])]
+    if not all(os.path.exists(f) for f in shard_files):
+        return False
+    try:
+        os.close(os.open(os.path.join(shards_folder, FAN_IN_MARKER), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+
+    parts = [anomaly_columns.load_anomalies(f, mmap=False) for f in shard_files]
+    save_anomalies(folder, anomaly_columns.concat_anomalies(parts))
+    records = [part['manifest'] for part in parts]
+    update_manifest(folder, {
+        'files': records[0]['files'],
+        'process': {
+            'key': records[0]['process']['key'],
+            'patches': {h: name for record in records for h, name in record['process']['patches'].items()},
+        },
+    })
+    shutil.rmtree(shards_folder, ignore_errors=True)
+    return True
+
+
+def detect_patches(folder, patches, model_name, confidentiality, batch_size, num_workers, engine):
+    """
+    Runs the model on the patches and returns the anomalies by patch name.
+    """
+    model = load_model(model_name, engine)
+    device = model.device
+
+    # --------------------
+
+    dataset = PatchDataset(folder, patches, patch_transforms())
+    # workers prefetch the following batches while the current one runs through the model
+    loader = DataLoader(dataset, batch_size=max(1, batch_size), num_workers=num_workers,
+                        collate_fn=collate_patches)
 
-    for image_fn in image_files:
+    anomalies = {}
 
-        print(f"Processing file {image_fn}...")
+    start = time.perf_counter()
+    for nr, (image_fns, images) in enumerate(loader):
 
-        img = Image.open(os.path.join(folder, image_fn)).convert('RGB')
+        print(f"Processing files {', '.join(image_fns)}...")
 
-        i = transforms(image=np.array(img))['image']
-        if device.type == 'cuda':
-            i = i.cuda()
+        images = [i.to(device) for i in images]
 
         with torch.no_grad():
-            predictions = model([i])
+            predictions = model(images)
 
-        if len(predictions) > 0 and len(predictions[0]['scores'].detach().cpu().tolist()) > 0:
-            p = predictions[0]
+        for image_fn, p in zip(image_fns, predictions):
+            if len(p['scores']) == 0:
+                continue
             idx = p['scores'].detach().cpu().numpy() > confidentiality
             scores = p['scores'].detach().cpu().numpy()[idx]
             if len(scores) > 0:
                 classes = p['labels'].detach().cpu().numpy()[idx]
-                boxes = p['boxes'].byte().detach().cpu().numpy()[idx]
-                contours = masks_to_contour(p['masks'][idx])
-                centers = center_from_contours(contours)
+                boxes = p['boxes'].round().int().detach().cpu().numpy()[idx]
+                contours = masks_to_contour(p['masks'][idx], p['boxes'][idx])
+                centers = center_from_masks(p['masks'][idx], p['boxes'][idx])
                 anomalies[image_fn] = {
                     'boxes': boxes,
                     'classes': classes,
@@ -125,20 +437,21 @@ def detect(folder, model_name, confidentiality=0.5):
                     'contours': contours,
                     'centers': centers,
                 }
-    save_anomalies(folder, anomalies)
 
-    return len(anomalies.keys())
+        # includes waiting for the loader, so it is the throughput of the whole pipeline
+        end = time.perf_counter()
+        logging.info('Batch %d: %d patches in %.2fs (%.2f patches/s)',
+                     nr, len(images), end - start, len(images) / max(end - start, 1e-9))
+        start = end
 
+    dataset.close()
+    return anomalies
 
-def save_anomalies(folder, anomalies):
-    class NumpyEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, np.ndarray):
-                return obj.tolist()
-            return json.JSONEncoder.default(self, obj)
 
-    with open(os.path.join(folder, ANOMALY_META), 'w') as m:
-        m.write(json.dumps(anomalies, indent=4, cls=NumpyEncoder))
+def save_anomalies(folder, data):
+    anomaly_columns.save_anomalies(os.path.join(folder, ANOMALY_META), data)
+    if ANOMALY_JSON_EXPORT:
+        anomaly_columns.export_json(os.path.join(folder, ANOMALY_JSON), data)
 
 
 def lambda_handler(event, context):
@@ -153,3 +466,10 @@ def lambda_handler(event, context):
         "patches": num_patches
     }
 
+
+if MODEL_WARMUP:
+    try:
+        warm_up_model(MODEL_NAME)
+    except Exception:
+        # the model is loaded again on the first job
+        logging.exception('Model warm up failed')
@@ -0,0 +1,378 @@
+import argparse
+import copy
+import logging
+import sys
+import time
+
+import numpy as np
+import torch
+from torchvision.ops import box_iou
+from torchvision.ops.misc import FrozenBatchNorm2d
+
+ENGINES = ('eager', 'torchscript', 'onnx', 'quantized')
+ENGINE_SUFFIX = {
+    'eager': '',
+    'torchscript': '.torchscript',
+    'onnx': '.onnx',
+    'quantized': '.quantized',
+}
+PARITY_BOX_TOLERANCE = 1.0  # pixel
+PARITY_SCORE_TOLERANCE = 1e-3
+PARITY_MASK_TOLERANCE = 1e-2  # mean absolute difference of mask probabilities
+QUANTIZED_BACKEND = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+MATCH_IOU = 0.5
+
+
+def engine_file(model_name, engine):
+    """
+    Returns the file name of the exported model for an engine, e.g. sunshaine.model.onnx.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown inference engine {engine}, expected one of {", ".join(ENGINES)}')
+    return model_name + ENGINE_SUFFIX[engine]
+
+
+def set_threads(intra_op_threads=0, inter_op_threads=0):
+    """
+    Sets the torch CPU thread pools, 0 keeps the torch default.
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # can only be set once per process, before any inter-op work started
+            logging.warning('Could not set inter-op threads, already initialised')
+
+
+class EagerEngine:
+    """
+    Runs the pickled torchvision model as is.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.device = next(model.parameters()).device
+
+    def __call__(self, images):
+        return self.model(images)
+
+
+class TorchScriptEngine:
+    """
+    Runs the scripted model. A scripted torchvision detection model returns
+    (losses, detections), only the detections are passed on.
+    """
+
+    def __init__(self, file_name):
+        self.module = torch.jit.load(file_name, map_location=torch.device('cpu'))
+        self.module.eval()
+        self.device = torch.device('cpu')
+
+    def __call__(self, images):
+        _, detections = self.module(images)
+        return detections
+
+
+class OnnxEngine:
+    """
+    Runs the exported ONNX graph with ONNX Runtime on CPU. The graph takes a single
+    image, so a batch is run image by image.
+    """
+
+    def __init__(self, file_name, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 0:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(file_name, sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.device = torch.device('cpu')
+
+    def __call__(self, images):
+        detections = []
+        for image in images:
+            outputs = self.session.run(None, {self.input_name: image.cpu().numpy()})
+            detections.append({name: torch.from_numpy(np.asarray(output))
+                               for name, output in zip(self.output_names, outputs)})
+        return detections
+
+
+def load_engine(model_name, engine='eager', intra_op_threads=0, inter_op_threads=0, device=None):
+    """
+    Loads the model for the given engine. The exported engines expect the model to be
+    exported before with export_model.
+    """
+    set_threads(intra_op_threads, inter_op_threads)
+    file_name = engine_file(model_name, engine)
+    if engine == 'torchscript':
+        return TorchScriptEngine(file_name)
+    if engine == 'onnx':
+        return OnnxEngine(file_name, intra_op_threads, inter_op_threads)
+    if engine == 'quantized':
+        # saved scripted, quantized kernels only run on CPU
+        torch.backends.quantized.engine = QUANTIZED_BACKEND
+        return TorchScriptEngine(file_name)
+    model = torch.load(file_name, map_location=torch.device('cpu'), weights_only=False)
+    model.eval()
+    if device is not None:
+        model.to(device)
+    return EagerEngine(model)
+
+
+def export_model(model_name, engine, height, width):
+    """
+    Exports the pickled model for the given engine next to the model file and returns
+    the file name of the export.
+    """
+    model = torch.load(model_name, map_location=torch.device('cpu'), weights_only=False)
+    model.eval()
+    file_name = engine_file(model_name, engine)
+    if engine == 'torchscript':
+        torch.jit.save(torch.jit.script(model), file_name)
+    elif engine == 'onnx':
+        dummy = torch.rand(3, height, width)
+        torch.onnx.export(model, ([dummy],), file_name, opset_version=11, dynamo=False,
+                          input_names=['image'],
+                          output_names=['boxes', 'labels', 'scores', 'masks'],
+                          dynamic_axes={'image': [1, 2], 'boxes': [0], 'labels': [0],
+                                        'scores': [0], 'masks': [0]})
+    else:
+        raise ValueError(f'Nothing to export for engine {engine}')
+    logging.info('Exported %s to %s', model_name, file_name)
+    return file_name
+
+
+def fold_frozen_batchnorm(module):
+    """
+    Folds the frozen batch norms of the ResNet backbone into the preceding convolutions,
+    so the backbone is a plain conv/relu network the quantizer can handle.
+    """
+    children = list(module.named_children())
+    for nr, (name, child) in enumerate(children):
+        if not isinstance(child, FrozenBatchNorm2d):
+            fold_frozen_batchnorm(child)
+            continue
+        # conv1/bn1 pairs in the ResNet blocks, conv/bn by index in the downsample sequence
+        conv_name = 'conv' + name[2:] if name.startswith('bn') else children[nr - 1][0]
+        conv = getattr(module, conv_name)
+        scale = child.weight * (child.running_var + child.eps).rsqrt()
+        bias = child.bias - child.running_mean * scale
+        if conv.bias is not None:
+            bias = bias + conv.bias * scale
+        conv.weight = torch.nn.Parameter(conv.weight * scale[:, None, None, None])
+        conv.bias = torch.nn.Parameter(bias)
+        setattr(module, name, torch.nn.Identity())
+    return module
+
+
+def quantize_model(model, calibration_images, static_backbone=True):
+    """
+    Returns an INT8 copy of the model for CPU inference. The linear layers of the box
+    head are quantized dynamically. If static_backbone is set, the ResNet body is also
+    quantized statically with activation ranges observed on the calibration images;
+    if the backbone cannot be traced it stays in float.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = QUANTIZED_BACKEND
+    model = copy.deepcopy(model).cpu().eval()
+
+    if static_backbone:
+        original = model.backbone.body
+        try:
+            body = fold_frozen_batchnorm(copy.deepcopy(original))
+            example = model.transform([calibration_images[0]])[0].tensors
+            prepared = prepare_fx(body, get_default_qconfig_mapping(QUANTIZED_BACKEND), (example,))
+            model.backbone.body = prepared
+            with torch.no_grad():
+                for image in calibration_images:
+                    model([image])
+            model.backbone.body = convert_fx(prepared)
+        except Exception:
+            logging.exception('Static quantization of the backbone failed, keeping it in float')
+            model.backbone.body = original
+
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def calibrate_model(model_name, calibration_images, static_backbone=True):
+    """
+    Quantizes the model with the calibration images and saves it next to the model file
+    for the 'quantized' engine. Returns the file name and the quantized model.
+    The quantized model is saved scripted, pickled quantized graph modules cannot be
+    loaded again.
+    """
+    model = torch.load(model_name, map_location=torch.device('cpu'), weights_only=False)
+    model.eval()
+    quantized = quantize_model(model, calibration_images, static_backbone)
+    file_name = engine_file(model_name, 'quantized')
+    torch.jit.save(torch.jit.script(quantized), file_name)
+    logging.info('Saved quantized model %s', file_name)
+    return file_name, quantized
+
+
+def match_detections(expected, actual, threshold):
+    """
+    Matches the detections above threshold of the reference model to detections of the
+    same class of the compared model. Returns (reference detections, matched, sum of IoU,
+    sum of absolute score deltas) of the matches.
+    """
+    exp_idx = expected['scores'] > threshold
+    act_idx = actual['scores'] > threshold
+    exp_boxes, exp_labels, exp_scores = (expected[k][exp_idx] for k in ('boxes', 'labels', 'scores'))
+    act_boxes, act_labels, act_scores = (actual[k][act_idx] for k in ('boxes', 'labels', 'scores'))
+    if len(exp_boxes) == 0 or len(act_boxes) == 0:
+        return len(exp_boxes), 0, 0.0, 0.0
+    iou = box_iou(exp_boxes, act_boxes)
+    iou[exp_labels[:, None] != act_labels[None, :]] = 0
+    best_iou, best = iou.max(dim=1)
+    matched = best_iou >= MATCH_IOU
+    score_delta = (exp_scores[matched] - act_scores[best[matched]]).abs()
+    return len(exp_boxes), int(matched.sum()), float(best_iou[matched].sum()), float(score_delta.sum())
+
+
+def quantization_report(reference, quantized, images, threshold):
+    """
+    Compares latency and detections of the fp32 and the quantized model on the images.
+    """
+    def timed(model):
+        outputs, seconds = [], 0.0
+        with torch.no_grad():
+            for image in images:
+                start = time.perf_counter()
+                outputs.append(model([image])[0])
+                seconds += time.perf_counter() - start
+        return outputs, seconds / max(len(images), 1)
+
+    expected, fp32_latency = timed(reference)
+    actual, int8_latency = timed(quantized)
+
+    detections = matched = 0
+    iou = score_delta = 0.0
+    for e, a in zip(expected, actual):
+        d, m, i, s = match_detections(e, a, threshold)
+        detections, matched, iou, score_delta = detections + d, matched + m, iou + i, score_delta + s
+    return {
+        'patches': len(images),
+        'fp32_latency': fp32_latency,
+        'int8_latency': int8_latency,
+        'speedup': fp32_latency / max(int8_latency, 1e-9),
+        'detections_fp32': detections,
+        'detections_int8': sum(int((a['scores'] > threshold).sum()) for a in actual),
+        'recall': matched / detections if detections > 0 else 1.0,
+        'mean_iou': iou / matched if matched > 0 else 0.0,
+        'mean_score_delta': score_delta / matched if matched > 0 else 0.0,
+    }
+
+
+def compare_detections(expected, actual):
+    """
+    Compares the detections of one image and returns the differences of boxes, scores
+    and masks. Detections are matched by order, which is by descending score for both.
+    """
+    n = len(expected['scores'])
+    result = {
+        'detections': n,
+        'detections_engine': len(actual['scores']),
+        'box': 0.0,
+        'score': 0.0,
+        'mask': 0.0,
+    }
+    if n != len(actual['scores']) or n == 0:
+        return result
+    result['box'] = float((expected['boxes'] - actual['boxes']).abs().max())
+    result['score'] = float((expected['scores'] - actual['scores']).abs().max())
+    result['mask'] = float((expected['masks'] - actual['masks']).abs().mean())
+    return result
+
+
+def check_parity(model_name, engine, images):
+    """
+    Runs the eager model and the exported engine on the same images and checks that
+    boxes, scores and masks agree within the parity tolerances.
+    Returns (passed, per image comparisons).
+    """
+    eager = load_engine(model_name, 'eager')
+    exported = load_engine(model_name, engine)
+    comparisons = []
+    with torch.no_grad():
+        for image in images:
+            expected = eager([image])[0]
+            actual = exported([image])[0]
+            comparisons.append(compare_detections(expected, actual))
+    passed = all(c['detections'] == c['detections_engine']
+                 and c['box'] <= PARITY_BOX_TOLERANCE
+                 and c['score'] <= PARITY_SCORE_TOLERANCE
+                 and c['mask'] <= PARITY_MASK_TOLERANCE
+                 for c in comparisons)
+    return passed, comparisons
+
+
+def parity_images(patches_folder, count):
+    # imported here, MlProcess imports this module
+    from . import PatchDataset, list_patches, patch_transforms
+    dataset = PatchDataset(patches_folder, list_patches(patches_folder)[:count], patch_transforms())
+    images = [dataset[i][1] for i in range(len(dataset))]
+    dataset.close()
+    return images
+
+
+def main(argv=None):
+    from . import MODEL_NAME, PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH
+
+    parser = argparse.ArgumentParser(description='Export or quantize the detection model and check engine parity.')
+    parser.add_argument('command', choices=['export', 'parity', 'calibrate'])
+    parser.add_argument('--engine', choices=ENGINES[1:3], help='engine to export or check')
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--patches', help='patches folder with patches used for the parity check or calibration')
+    parser.add_argument('--count', type=int, default=8, help='number of patches for the parity check')
+    parser.add_argument('--calibration-count', type=int, default=32,
+                        help='number of patches observed for calibration, the following --count patches are used for the report')
+    parser.add_argument('--dynamic-only', action='store_true', help='keep the backbone in float')
+    parser.add_argument('--threshold', type=float, default=0.75, help='score threshold for the accuracy report')
+    args = parser.parse_args(argv)
+
+    if args.command == 'calibrate':
+        if not args.patches:
+            parser.error('calibrate needs --patches')
+        images = parity_images(args.patches, args.calibration_count + args.count)
+        calibration, evaluation = images[:args.calibration_count], images[args.calibration_count:]
+        file_name, quantized = calibrate_model(args.model, calibration, not args.dynamic_only)
+        print(file_name)
+        reference = load_engine(args.model, 'eager').model
+        report = quantization_report(reference, quantized, evaluation or calibration, args.threshold)
+        print(f"patches {report['patches']}: fp32 {report['fp32_latency']:.3f}s, "
+              f"int8 {report['int8_latency']:.3f}s per patch, speedup {report['speedup']:.2f}x")
+        print(f"detections fp32 {report['detections_fp32']}, int8 {report['detections_int8']}, "
+              f"recall {report['recall']:.3f}, mean IoU {report['mean_iou']:.3f}, "
+              f"mean score delta {report['mean_score_delta']:.4f}")
+        return 0
+
+    if args.engine is None:
+        parser.error(f'{args.command} needs --engine')
+
+    if args.command == 'export':
+        print(export_model(args.model, args.engine, PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH))
+        return 0
+
+    if args.patches:
+        images = parity_images(args.patches, args.count)
+    else:
+        images = [torch.rand(3, PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH) for _ in range(args.count)]
+    passed, comparisons = check_parity(args.model, args.engine, images)
+    for nr, c in enumerate(comparisons):
+        print(f"{nr}: detections {c['detections']}/{c['detections_engine']}, "
+              f"box {c['box']:.4f}, score {c['score']:.6f}, mask {c['mask']:.6f}")
+    print('parity ok' if passed else 'parity FAILED')
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,9 @@
 import logging
-from pyodm import Node
 
 import azure.functions as func
 
+from shared_code.odm_nodes import task_node
+
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
@@ -16,10 +17,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         else:
             name = req_body.get('name')
 
-    n = Node('nodeodm-sunshaine.azurewebsites.net', 80)
-    task = n.get_task(name)
-
     if name:
+        n = task_node(name)
+        task = n.get_task(name)
         return func.HttpResponse(task.info().status.name)
     else:
         return func.HttpResponse(
@@ -1,14 +1,24 @@
 import logging
 import os
-from pyodm import Node
+from pyodm.types import TaskStatus
 
 import azure.functions as func
 
+from shared_code.odm_download import download_task
+from shared_code.odm_nodes import task_node, update_task
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+# root of the downloaded ODM tasks, one folder per uuid
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
+# comma separated NodeODM assets to download when the request names none, e.g. 'orthophoto.tif';
+# empty downloads and extracts the complete all.zip
+DOWNLOAD_ASSETS = os.environ.get('DOWNLOAD_ASSETS', '')
+
+
+def main(req: func.HttpRequest, msgout: func.Out[str]) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     name = req.params.get('name')
+    assets = req.params.get('assets')
     if not name:
         try:
             req_body = req.get_json()
@@ -16,13 +26,27 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             pass
         else:
             name = req_body.get('name')
+            assets = assets or req_body.get('assets')
 
-    n = Node('nodeodm-sunshaine.azurewebsites.net', 80)
-    task = n.get_task(name)
-    dir = os.path.join('/datashare/downloads/', name)
-    task.download_assets(dir)
-    logging.info('downloaded')
     if name:
+        n = task_node(name)
+        task = n.get_task(name)
+        dir = os.path.join(DOWNLOADS_FOLDER, name)
+        assets = assets if assets is not None else DOWNLOAD_ASSETS
+        if isinstance(assets, str):
+            assets = [a.strip() for a in assets.split(',') if a.strip()]
+        if len(assets) > 0:
+            status = task.info().status
+            if status != TaskStatus.COMPLETED:
+                return func.HttpResponse(f"Task is {status.name}, not completed", status_code=409)
+        try:
+            download_task(n, name, dir, assets)
+        except ValueError as e:
+            return func.HttpResponse(str(e), status_code=400)
+        logging.info('downloaded')
+        update_task(name, state='downloaded')
+        # start the ML pipeline on the downloaded orthophoto
+        msgout.set(name)
         return func.HttpResponse("downloaded")
     else:
         return func.HttpResponse(
@@ -1,31 +1,51 @@
 import logging
 import os
-from pyodm import Node
+import time
 
 import azure.functions as func
 
+from shared_code.odm_nodes import NoNodeError, choose_node, get_node, update_task
+from shared_code.odm_upload import UploadError, start_task
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
-
-    name = req.params.get('name')
-    if not name:
-        try:
-            req_body = req.get_json()
-        except ValueError:
-            pass
-        else:
-            name = req_body.get('name')
-    
-    dir = os.path.join('/datashare/', name)
-    files = os.listdir(dir)
-    files = [os.path.join(dir, f) for f in files]
-
-    logging.info("Files loaded: %s" % len(files))
-
-    n = Node('nodeodm-sunshaine.azurewebsites.net', 80)
+# concurrent image uploads per task
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '8'))
+# longer image side in pixels images are downscaled to before the upload, 0 uploads the originals
+UPLOAD_MAX_IMAGE_SIZE = int(os.environ.get('UPLOAD_MAX_IMAGE_SIZE', '0'))
 
-    task = n.create_task(files, options = {
+# ODM options by processing profile. The ML pipeline only needs the orthophoto:
+# 'fast-ortho' builds it from the sparse reconstruction without point cloud, DEMs,
+# mesh and report, 'standard' keeps the point cloud and DSM at lower quality,
+# 'full' computes everything at the highest quality.
+PROCESSING_PROFILES = {
+    'fast-ortho': {
+        'fast-orthophoto' : True,
+        'orthophoto-resolution' : 1,
+        'skip-3dmodel' : True,
+        'skip-report' : True,
+        'resize-to' : -1,
+        'min-num-features' : 10000,
+        'orthophoto-cutline' : False,
+        'feature-quality' : 'high',
+        'gps-accuracy' : 3,
+        'auto-boundary' : True,
+        'radiometric-calibration' : "camera"
+    },
+    'standard': {
+        'dsm' : True,
+        'orthophoto-resolution' : 1,
+        'skip-3dmodel' : True,
+        'skip-report' : True,
+        'resize-to' : -1,
+        'min-num-features' : 15000,
+        'orthophoto-cutline' : False,
+        'pc-quality' : 'medium',
+        'feature-quality' : 'high',
+        'dem-resolution' : 2,
+        'gps-accuracy' : 3,
+        'auto-boundary' : True,
+        'radiometric-calibration' : "camera"
+    },
+    'full': {
         'dsm' : True,
         'orthophoto-resolution' : 1,
         'skip-3dmodel' : True,
@@ -41,14 +61,70 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         'mesh-octree-depth' : 13,
         'auto-boundary' : True,
         'radiometric-calibration' : "camera"
-    }, name=name)
+    },
+}
+# profile of requests naming none
+PROCESSING_PROFILE = os.environ.get('PROCESSING_PROFILE', 'full')
+
+
+def upload_done(uuid, error):
+    if error is not None:
+        # the watcher stops checking the task
+        update_task(uuid, state='failed', last_error=str(error))
 
-    logging.info("Task created with uuid: %s" % task.info().uuid)
 
-    if name:
-        return func.HttpResponse(task.info().uuid)
-    else:
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+
+    name = req.params.get('name')
+    profile = req.params.get('profile')
+    if not name:
+        try:
+            req_body = req.get_json()
+        except ValueError:
+            pass
+        else:
+            name = req_body.get('name')
+            profile = profile or req_body.get('profile')
+
+    if not name:
         return func.HttpResponse(
              "No foldername provided",
              status_code=200
-        )
\ No newline at end of file
+        )
+
+    profile = profile or PROCESSING_PROFILE
+    if profile not in PROCESSING_PROFILES:
+        return func.HttpResponse(
+             f"Unknown profile {profile}, known are {', '.join(PROCESSING_PROFILES)}",
+             status_code=400
+        )
+
+    dir = os.path.join('/datashare/', name)
+    files = os.listdir(dir)
+    files = [os.path.join(dir, f) for f in files]
+
+    logging.info("Files loaded: %s" % len(files))
+    if len(files) == 0:
+        return func.HttpResponse(f"No images in {name}", status_code=400)
+
+    try:
+        node = choose_node(len(files))
+    except NoNodeError as e:
+        return func.HttpResponse(str(e), status_code=503)
+    n = get_node(node)
+
+    # returns once the task exists, the images are uploaded in the background
+    try:
+        uuid = start_task(n, files, options=PROCESSING_PROFILES[profile], name=name, workers=UPLOAD_WORKERS,
+                          max_size=UPLOAD_MAX_IMAGE_SIZE, on_done=upload_done)
+    except UploadError as e:
+        logging.error("Task for %s not created on node %s: %s" % (name, node, e))
+        return func.HttpResponse(str(e), status_code=502)
+
+    # merged, the upload may already have failed and marked the task, which then stays failed
+    update_task(uuid, node=node, name=name, images=len(files), profile=profile,
+                options=PROCESSING_PROFILES[profile], created=time.time())
+    logging.info("Task created with uuid: %s on node %s, profile %s" % (uuid, node, profile))
+
+    return func.HttpResponse(uuid)
@@ -0,0 +1,137 @@
+import logging
+import os
+import fnmatch
+import re
+import threading
+from collections import OrderedDict
+
+import azure.functions as func
+
+import cv2
+import numpy as np
+from osgeo import gdal
+
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
+ORTHOPHOTO_FOLDER = 'odm_orthophoto'
+# annotated result GeoTIFF written by MlPostprocess
+RESULT_PATTERN = '*-result.tif'
+TILE_SIZE = 256
+TILE_MAX_ZOOM = 24
+TILE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+# half the extent of the web mercator (EPSG:3857) world in meters
+WEB_MERCATOR_EXTENT = 20037508.342789244
+# upper bound of the encoded tiles kept in memory by this worker process
+TILE_CACHE_BYTES = int(os.environ.get('TILE_CACHE_BYTES', str(64 * 1024 * 1024)))
+# seconds clients may use a tile without asking again
+TILE_MAX_AGE = int(os.environ.get('TILE_MAX_AGE', '3600'))
+UUID_PATTERN = re.compile(r'^[0-9a-fA-F-]+$')
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    uuid = req.route_params.get('uuid', '')
+    ext = req.route_params.get('ext', '').lower()
+    try:
+        z, x, y = [int(req.route_params.get(k)) for k in ('z', 'x', 'y')]
+    except (TypeError, ValueError):
+        return func.HttpResponse("Invalid tile coordinates", status_code=400)
+
+    if not UUID_PATTERN.match(uuid) or ext not in TILE_FORMATS:
+        return func.HttpResponse("Invalid uuid or tile format", status_code=400)
+    if not 0 <= z <= TILE_MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return func.HttpResponse("Tile out of range", status_code=400)
+
+    result_name = find_result(uuid)
+    if result_name is None:
+        return func.HttpResponse(f"No result for {uuid}", status_code=404)
+
+    # a new result gets a new modification time, which invalidates cached tiles and ETags
+    stat = os.stat(result_name)
+    version = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    etag = f'"{version}-{z}-{x}-{y}-{ext}"'
+    headers = {
+        'Cache-Control': f'public, max-age={TILE_MAX_AGE}',
+        'ETag': etag,
+    }
+    if req.headers.get('If-None-Match') == etag:
+        return func.HttpResponse(status_code=304, headers=headers)
+
+    key = (result_name, version, z, x, y, ext)
+    tile = _tiles.get(key)
+    if tile is None:
+        logging.debug('Rendering tile %s/%d/%d/%d.%s', uuid, z, x, y, ext)
+        tile = render_tile(result_name, z, x, y, ext)
+        _tiles.put(key, tile)
+    return func.HttpResponse(tile, status_code=200, headers=headers, mimetype=TILE_FORMATS[ext])
+
+
+def find_result(uuid):
+    folder = os.path.join(DOWNLOADS_FOLDER, uuid, ORTHOPHOTO_FOLDER)
+    if not os.path.isdir(folder):
+        return None
+    results = sorted(f for f in os.listdir(folder) if fnmatch.fnmatch(f, RESULT_PATTERN))
+    return os.path.join(folder, results[0]) if len(results) > 0 else None
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds (min x, min y, max x, max y) of the XYZ tile in web mercator meters.
+    """
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+    min_x = -WEB_MERCATOR_EXTENT + x * size
+    max_y = WEB_MERCATOR_EXTENT - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def render_tile(file_name, z, x, y, ext):
+    """
+    Warps the tile from the result GeoTIFF and encodes it. GDAL reads only the blocks of
+    the overview level matching the zoom, areas outside the result stay transparent.
+    """
+    tile = gdal.Warp('', file_name, options=gdal.WarpOptions(
+        format='MEM', dstSRS='EPSG:3857', outputBounds=tile_bounds(z, x, y),
+        width=TILE_SIZE, height=TILE_SIZE, dstAlpha=True, resampleAlg='bilinear'))
+    # RGB and alpha band as BGRA for cv2
+    bands = [3, 2, 1, 4] if tile.RasterCount >= 4 else [1, 1, 1, 2]
+    image = np.dstack([tile.GetRasterBand(b).ReadAsArray() for b in bands])
+    ok, data = cv2.imencode('.' + ext, image)
+    if not ok:
+        raise RuntimeError(f'Could not encode tile {z}/{x}/{y}.{ext}')
+    return data.tobytes()
+
+
+class TileCache:
+    """
+    Least recently used cache of encoded tiles, bounded by the total size of the tiles.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        if len(tile) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.tiles:
+                self.bytes -= len(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.bytes += len(tile)
+            while self.bytes > self.max_bytes:
+                _, evicted = self.tiles.popitem(last=False)
+                self.bytes -= len(evicted)
+
+
+# tiles rendered by this worker process
+_tiles = TileCache(TILE_CACHE_BYTES)
@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from pyodm.types import TaskStatus
+
+import azure.functions as func
+
+from shared_code.odm_download import download_task
+from shared_code.odm_nodes import FINAL_STATES, get_node, list_tasks, update_task
+
+# root of the downloaded ODM tasks, one folder per uuid
+DOWNLOADS_FOLDER = os.environ.get('DOWNLOADS_FOLDER', '/datashare/downloads')
+# assets downloaded for the ML pipeline, empty downloads the complete all.zip
+WATCH_DOWNLOAD_ASSETS = os.environ.get('WATCH_DOWNLOAD_ASSETS', 'orthophoto.tif')
+# seconds between status checks of a task, doubled after every check up to the maximum
+WATCH_MIN_INTERVAL = int(os.environ.get('WATCH_MIN_INTERVAL', '60'))
+WATCH_MAX_INTERVAL = int(os.environ.get('WATCH_MAX_INTERVAL', '900'))
+# consecutive failed status checks or downloads after which a task is given up as failed,
+# e.g. a task lost by the node or an upload that never reached it
+WATCH_MAX_FAILURES = int(os.environ.get('WATCH_MAX_FAILURES', '20'))
+# seconds after its creation a task is given up as failed if it has not completed
+WATCH_MAX_AGE = int(os.environ.get('WATCH_MAX_AGE', str(3 * 24 * 3600)))
+# concurrent status requests of one sweep
+WATCH_WORKERS = 8
+
+
+def main(timer: func.TimerRequest, msgout: func.Out[typing.List[str]]) -> None:
+    downloaded = sweep_tasks()
+    if len(downloaded) > 0:
+        # start the ML pipeline on the downloaded orthophotos
+        msgout.set(downloaded)
+    logging.info('Task sweep done, %d downloaded', len(downloaded))
+
+
+def next_interval(checks):
+    return min(WATCH_MIN_INTERVAL * 2 ** checks, WATCH_MAX_INTERVAL)
+
+
+def due_tasks(records, now):
+    return [r for r in records
+            if 'node' in r and r.get('state') not in FINAL_STATES and r.get('next_check', 0) <= now]
+
+
+def task_status(record):
+    try:
+        return get_node(record['node']).get_task(record['uuid']).info()
+    except Exception as e:
+        logging.warning('Status of task %s not available: %s', record['uuid'], e)
+        return None
+
+
+def sweep_tasks(now=None):
+    """
+    Checks the status of all in-flight tasks that are due in one parallel sweep and
+    downloads the completed ones. Tasks still running are checked again after an
+    interval growing with every check, until they are too old or their status or
+    download failed WATCH_MAX_FAILURES times in a row. Returns the uuids of the
+    downloaded tasks.
+    """
+    now = time.time() if now is None else now
+    records = due_tasks(list_tasks(), now)
+    if len(records) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=WATCH_WORKERS) as pool:
+        infos = list(pool.map(task_status, records))
+
+    assets = [a.strip() for a in WATCH_DOWNLOAD_ASSETS.split(',') if a.strip()]
+    downloaded = []
+    for record, info in zip(records, infos):
+        uuid, checks = record['uuid'], record.get('checks', 0)
+        if info is not None and info.status == TaskStatus.COMPLETED:
+            try:
+                download_task(get_node(record['node']), uuid, os.path.join(DOWNLOADS_FOLDER, uuid), assets)
+            except Exception as e:
+                logging.exception('Download of task %s failed', uuid)
+                retry_later(record, now, f'Download failed: {e}')
+                continue
+            update_task(uuid, state='downloaded', status=info.status.name, downloaded=time.time())
+            downloaded.append(uuid)
+        elif info is not None and info.status in (TaskStatus.FAILED, TaskStatus.CANCELED):
+            state = 'failed' if info.status == TaskStatus.FAILED else 'canceled'
+            logging.warning('Task %s %s: %s', uuid, state, info.last_error)
+            update_task(uuid, state=state, status=info.status.name, last_error=info.last_error)
+        elif info is None:
+            retry_later(record, now, 'Status not available')
+        elif now - record.get('created', now) > WATCH_MAX_AGE:
+            give_up(record, f'Not completed after {WATCH_MAX_AGE}s')
+        else:
+            update_task(uuid, checks=checks + 1, next_check=now + next_interval(checks), failures=0,
+                        status=info.status.name, progress=info.progress)
+    return downloaded
+
+
+def give_up(record, error):
+    logging.warning('Giving up task %s: %s', record['uuid'], error)
+    update_task(record['uuid'], state='failed', last_error=error)
+
+
+def retry_later(record, now, error):
+    """
+    Checks the task again after the next interval, or gives it up as failed once it
+    failed too often in a row or is too old.
+    """
+    checks, failures = record.get('checks', 0), record.get('failures', 0) + 1
+    if failures >= WATCH_MAX_FAILURES:
+        give_up(record, f'{error}, {failures} times in a row')
+    elif now - record.get('created', now) > WATCH_MAX_AGE:
+        give_up(record, f'{error}, not completed after {WATCH_MAX_AGE}s')
+    else:
+        update_task(record['uuid'], checks=checks + 1, next_check=now + next_interval(checks),
+                    failures=failures, last_error=error)
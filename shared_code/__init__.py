@@ -0,0 +1 @@
+# helpers shared between the functions of this app, importable as `shared_code`
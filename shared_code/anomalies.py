@@ -0,0 +1,197 @@
+"""
+Columnar layout of the detected anomalies, shared by MlProcess and MlPostprocess.
+
+Per detection (N rows):  boxes (N, 4), classes (N,), scores (N,), centers (N, 2) and
+                         any further per detection column, e.g. latlong (N, 3)
+Contours:                contour_offsets (N + 1,) index the contours of detection i,
+                         point_offsets (C + 1,) the points of contour j in points (P, 2)
+                         and point_latlong (P, 2) once geo-referenced
+Per patch (optional):    patch_names (attribute) and patch_offsets (M + 1,) index the
+                         detections of patch k
+
+The JSON export reproduces the nested layout of the former anomalies.json.
+"""
+import json
+import sys
+
+import numpy as np
+
+from .columnar import load_columns, save_columns
+
+DETECTION_COLUMNS = {
+    'boxes': (np.int32, (-1, 4)),
+    'classes': (np.int64, (-1,)),
+    'scores': (np.float32, (-1,)),
+    'centers': (np.int32, (-1, 2)),
+}
+STRUCTURE_COLUMNS = ('contour_offsets', 'point_offsets', 'points', 'point_latlong', 'patch_offsets', 'patch_names')
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def pack_detections(boxes, classes, scores, centers, contours, **extra):
+    """
+    Packs the detections, given as sequences with one entry per detection, into columns.
+    contours holds the contours of each detection as arrays or nested lists of points.
+    Extra keyword arguments are stored as further per detection columns.
+    """
+    data = {}
+    for name, values in [('boxes', boxes), ('classes', classes), ('scores', scores), ('centers', centers)]:
+        dtype, shape = DETECTION_COLUMNS[name]
+        data[name] = np.asarray(values, dtype=dtype).reshape(shape)
+    for name, values in extra.items():
+        values = np.asarray(values, dtype=np.float64)
+        data[name] = values if values.ndim > 1 else values.reshape(-1, 1)
+
+    points = [np.asarray(c, dtype=np.int32).reshape(-1, 2) for detection in contours for c in detection]
+    data['contour_offsets'] = _offsets([len(detection) for detection in contours])
+    data['point_offsets'] = _offsets([len(p) for p in points])
+    data['points'] = np.concatenate(points) if points else np.empty((0, 2), dtype=np.int32)
+    return data
+
+
+def pack_anomalies(patch_anomalies):
+    """
+    Packs the anomalies of the patches, a dict by patch name with lists of boxes,
+    classes, scores, contours and centers, into columns grouped by patch.
+    """
+    names = list(patch_anomalies)
+    detections = {key: [] for key in ('boxes', 'classes', 'scores', 'centers', 'contours')}
+    for name in names:
+        for key in detections:
+            detections[key].extend(list(patch_anomalies[name][key]))
+    data = pack_detections(**detections)
+    data['patch_names'] = names
+    data['patch_offsets'] = _offsets([len(patch_anomalies[name]['scores']) for name in names])
+    return data
+
+
+def gather_ranges(starts, lengths):
+    """
+    Concatenation of the index ranges start:start+length, without a Python loop.
+    """
+    starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    # position of every output index within its range, then shift by the range start
+    range_starts = _offsets(lengths)[:-1]
+    return np.arange(total, dtype=np.int64) + np.repeat(starts - range_starts, lengths)
+
+
+def select_detections(data, detections, shifts=None):
+    """
+    Returns the columns of the given detections, in that order. If shifts (one x, y
+    per detection) are given, they are added to boxes, centers and contour points.
+    """
+    detections = np.asarray(detections, dtype=np.int64)
+    result = {name: np.asarray(data[name][detections]) for name in detection_columns(data)}
+
+    contour_offsets, point_offsets = data['contour_offsets'], data['point_offsets']
+    contour_counts = contour_offsets[detections + 1] - contour_offsets[detections]
+    contours = gather_ranges(contour_offsets[detections], contour_counts)
+    point_counts = point_offsets[contours + 1] - point_offsets[contours]
+    result['contour_offsets'] = _offsets(contour_counts)
+    result['point_offsets'] = _offsets(point_counts)
+    result['points'] = np.asarray(data['points'][gather_ranges(point_offsets[contours], point_counts)])
+
+    if shifts is not None:
+        shifts = np.asarray(shifts, dtype=np.int32).reshape(-1, 2)
+        result['boxes'] = result['boxes'] + np.tile(shifts, 2)
+        result['centers'] = result['centers'] + shifts
+        point_shifts = np.repeat(np.repeat(shifts, contour_counts, axis=0), point_counts, axis=0)
+        result['points'] = result['points'] + point_shifts
+    return result
+
+
+def concat_anomalies(parts):
+    """
+    Concatenates anomalies grouped by patch, e.g. the results of several shards of a job,
+    in the given order. Offset columns are rebased onto the concatenated columns.
+    """
+    def rebased(name):
+        # the last offset of a part is its number of contours, points or detections
+        bases = _offsets([part[name][-1] for part in parts])
+        return np.concatenate([np.zeros(1, dtype=np.int64)] +
+                              [part[name][1:] + base for part, base in zip(parts, bases)])
+
+    data = {name: np.concatenate([part[name] for part in parts]) for name in detection_columns(parts[0])}
+    data['contour_offsets'] = rebased('contour_offsets')
+    data['point_offsets'] = rebased('point_offsets')
+    data['points'] = np.concatenate([part['points'] for part in parts])
+    data['patch_names'] = [name for part in parts for name in part['patch_names']]
+    data['patch_offsets'] = rebased('patch_offsets')
+    return data
+
+
+def detection_contours(data, i):
+    """
+    Contours of detection i as list of (n, 1, 2) arrays, as returned by cv2.findContours.
+    """
+    point_offsets, points = data['point_offsets'], data['points']
+    return [points[point_offsets[c]:point_offsets[c + 1]].reshape(-1, 1, 2)
+            for c in range(data['contour_offsets'][i], data['contour_offsets'][i + 1])]
+
+
+def empty_anomalies():
+    return pack_detections([], [], [], [], [])
+
+
+def detection_columns(data):
+    """
+    Names of all per detection columns, including extra ones like latlong.
+    """
+    return [name for name in data if name not in STRUCTURE_COLUMNS and isinstance(data[name], np.ndarray)]
+
+
+def unpack_detections(data, start=0, end=None):
+    """
+    Returns the detections start:end as dict of lists in the nested JSON layout,
+    contours as [[[x, y]], ...] per contour.
+    """
+    end = len(data['scores']) if end is None else end
+    result = {name: data[name][start:end].tolist() for name in detection_columns(data)}
+    contour_offsets, point_offsets, points = data['contour_offsets'], data['point_offsets'], data['points']
+    result['contours'] = [
+        [points[point_offsets[c]:point_offsets[c + 1]].reshape(-1, 1, 2).tolist()
+         for c in range(contour_offsets[i], contour_offsets[i + 1])]
+        for i in range(start, end)
+    ]
+    return result
+
+
+def unpack_anomalies(data):
+    """
+    Returns the anomalies in the nested JSON layout: a dict by patch name if the
+    anomalies are grouped by patch, a single dict of lists otherwise.
+    """
+    if 'patch_names' not in data:
+        return unpack_detections(data)
+    offsets = data['patch_offsets']
+    return {name: unpack_detections(data, offsets[k], offsets[k + 1])
+            for k, name in enumerate(data['patch_names'])}
+
+
+def save_anomalies(file_name, data):
+    save_columns(file_name, data)
+
+
+def load_anomalies(file_name, mmap=True):
+    return load_columns(file_name, mmap)
+
+
+def export_json(file_name, data):
+    """
+    Writes the anomalies as JSON in the nested layout for external consumers.
+    """
+    with open(file_name, 'w') as m:
+        m.write(json.dumps(unpack_anomalies(data), indent=4))
+
+
+if __name__ == '__main__':
+    # python -m shared_code.anomalies <anomalies.bin> <anomalies.json>
+    export_json(sys.argv[2], load_anomalies(sys.argv[1]))
@@ -0,0 +1,78 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+# file layout: magic, header length (uint64 little endian), JSON header, then the raw
+# column buffers, each aligned to COLUMN_ALIGNMENT bytes so they can be memory-mapped
+COLUMNAR_MAGIC = b'COLS0001'
+COLUMN_ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + COLUMN_ALIGNMENT - 1) // COLUMN_ALIGNMENT * COLUMN_ALIGNMENT
+
+
+def save_columns(file_name, data):
+    """
+    Saves a dict to a columnar file. numpy arrays are stored as raw column buffers,
+    all other (JSON serializable) values as attributes in the header.
+    The file is written next to the target and renamed, so readers never see a
+    partially written file.
+    """
+    columns = {k: np.ascontiguousarray(v) for k, v in data.items() if isinstance(v, np.ndarray)}
+    attrs = {k: v for k, v in data.items() if not isinstance(v, np.ndarray)}
+
+    # offsets relative to the start of the data section
+    layout, offset = {}, 0
+    for name, column in columns.items():
+        offset = _aligned(offset)
+        layout[name] = {
+            'dtype': column.dtype.str,
+            'shape': list(column.shape),
+            'offset': offset,
+        }
+        offset += column.nbytes
+
+    header = json.dumps({'columns': layout, 'attrs': attrs}).encode('utf-8')
+    data_start = _aligned(len(COLUMNAR_MAGIC) + 8 + len(header))
+
+    tmp_name = f'{file_name}.tmp{os.getpid()}'
+    with open(tmp_name, 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, column in columns.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(column.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_name, file_name)
+
+
+def load_columns(file_name, mmap=True):
+    """
+    Loads a columnar file into a dict of numpy arrays and attributes. With mmap the
+    columns are read-only memory maps of the file, so only the accessed parts are read.
+    """
+    with open(file_name, 'rb') as f:
+        magic = f.read(len(COLUMNAR_MAGIC))
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError(f'{file_name} is not a columnar file')
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(COLUMNAR_MAGIC) + 8 + header_length)
+
+    data = dict(header['attrs'])
+    for name, column in header['columns'].items():
+        dtype, shape = np.dtype(column['dtype']), tuple(column['shape'])
+        offset = data_start + column['offset']
+        if int(np.prod(shape)) == 0:
+            # empty columns cannot be memory-mapped
+            data[name] = np.empty(shape, dtype=dtype)
+        elif mmap:
+            data[name] = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            data[name] = np.fromfile(file_name, dtype=dtype, count=int(np.prod(shape)),
+                                     offset=offset).reshape(shape)
+    return data
@@ -0,0 +1,69 @@
+"""
+Per job manifest (manifest.json next to mosaics.json) recording the content hashes the
+outputs of the ML stages were computed from, so re-runs of a job skip unchanged work.
+
+files:       sha256 of input files by path, with size and modification time to
+             avoid hashing unchanged files again
+preprocess:  inputs (orthophoto hashes and patch parameters) of the current patches
+process:     key (model hash, engine, threshold, version) of the current anomalies and the
+             patch they were detected in by patch hash
+"""
+import hashlib
+import json
+import os
+
+MANIFEST = 'manifest.json'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_array(array):
+    """
+    sha256 of the pixels of an array, independent of how the array is stored on disk.
+    """
+    return hashlib.sha256(memoryview(array if array.flags.c_contiguous else array.copy())).hexdigest()
+
+
+def file_hash(file_name, manifest=None):
+    """
+    sha256 of the file. If a manifest is given, the hash is cached in it and only
+    computed again when the size or modification time of the file changed.
+    """
+    stat = os.stat(file_name)
+    files = manifest.setdefault('files', {}) if manifest is not None else {}
+    key = os.path.abspath(file_name)
+    cached = files.get(key)
+    if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha256']
+
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    files[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': h.hexdigest()}
+    return files[key]['sha256']
+
+
+def write_json(file_name, data, indent=None):
+    """
+    Writes JSON next to the target and renames it, so readers never see a partial file.
+    """
+    tmp_name = f'{file_name}.tmp{os.getpid()}'
+    with open(tmp_name, 'w') as f:
+        f.write(json.dumps(data, indent=indent))
+    os.replace(tmp_name, file_name)
+
+
+def load_manifest(folder):
+    file_name = os.path.join(folder, MANIFEST)
+    if not os.path.exists(file_name):
+        return {}
+    try:
+        with open(file_name, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # unreadable manifest: everything is computed again
+        return {}
+
+
+def save_manifest(folder, manifest):
+    write_json(os.path.join(folder, MANIFEST), manifest, indent=4)
@@ -0,0 +1,180 @@
+"""
+Downloads single assets of a NodeODM task instead of the whole all.zip archive.
+Each asset is fetched with parallel HTTP range requests written straight into place.
+The finished chunks are recorded in a sidecar file, so an interrupted download
+continues where it stopped.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .manifest import write_json
+from .odm_session import session_for
+
+# NodeODM asset name: path of the file in the task folder, as extracted from all.zip
+ASSET_PATHS = {
+    'orthophoto.tif': 'odm_orthophoto/odm_orthophoto.tif',
+    'orthophoto.png': 'odm_orthophoto/odm_orthophoto.png',
+    'orthophoto.mbtiles': 'odm_orthophoto/odm_orthophoto.mbtiles',
+    'dsm.tif': 'odm_dem/dsm.tif',
+    'dtm.tif': 'odm_dem/dtm.tif',
+    'georeferenced_model.laz': 'odm_georeferencing/odm_georeferenced_model.laz',
+    'cameras.json': 'cameras.json',
+    'shots.geojson': 'odm_report/shots.geojson',
+    'report.pdf': 'odm_report/report.pdf',
+}
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_TIMEOUT = 60
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+
+def asset_url(node, uuid, asset):
+    # fresh query dict, Node.url adds the token to it
+    return node.url(f'/task/{uuid}/download/{asset}', {})
+
+
+def asset_size(session, url):
+    """
+    Returns the size of the asset and whether the server answers range requests.
+    """
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+            return int(r.headers['Content-Range'].rsplit('/', 1)[1]), True
+        length = r.headers.get('Content-Length')
+        return (int(length) if length is not None else None), False
+
+
+def load_state(state_name, size, chunk_size):
+    """
+    Chunks already downloaded by an interrupted run of the same asset, if any.
+    """
+    if not os.path.exists(state_name):
+        return set()
+    try:
+        with open(state_name, 'r') as f:
+            state = json.load(f)
+    except ValueError:
+        return set()
+    if state.get('size') != size or state.get('chunk_size') != chunk_size:
+        return set()
+    return set(state['done'])
+
+
+def download_chunk(session, url, fd, start, end):
+    """
+    Downloads bytes start..end (inclusive) of the asset into the file at the same offset.
+    """
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            with session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True,
+                             timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise IOError(f'Range request not answered with 206 but {r.status_code}')
+                offset = start
+                for data in r.iter_content(1024 * 1024):
+                    offset += os.pwrite(fd, data, offset)
+            if offset == end + 1:
+                return
+            raise IOError(f'Chunk {start}-{end} incomplete, got {offset - start} bytes')
+        except (requests.RequestException, IOError) as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            logging.warning('Chunk %d-%d failed (%s), retrying', start, end, e)
+            time.sleep(2 ** attempt)
+
+
+def download_file(session, url, file_name, workers=DOWNLOAD_WORKERS, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads the url to file_name with parallel range requests, resuming a previous
+    partial download. Falls back to one streamed request if ranges are not supported.
+    The file only appears under its name once it is complete.
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    part_name, state_name = file_name + PART_SUFFIX, file_name + STATE_SUFFIX
+    size, ranges = asset_size(session, url)
+
+    if not ranges or size is None:
+        with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            r.raise_for_status()
+            with open(part_name, 'wb') as f:
+                for data in r.iter_content(1024 * 1024):
+                    f.write(data)
+        os.replace(part_name, file_name)
+        return os.path.getsize(file_name)
+
+    chunks = (size + chunk_size - 1) // chunk_size
+    done = load_state(state_name, size, chunk_size) if os.path.exists(part_name) else set()
+    if len(done) > 0:
+        logging.info('Resuming %s, %d of %d chunks done', file_name, len(done), chunks)
+
+    lock = threading.Lock()
+    fd = os.open(part_name, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(chunk):
+            start = chunk * chunk_size
+            download_chunk(session, url, fd, start, min(start + chunk_size, size) - 1)
+            with lock:
+                done.add(chunk)
+                write_json(state_name, {'size': size, 'chunk_size': chunk_size, 'done': sorted(done)})
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(fetch, c) for c in range(chunks) if c not in done]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                # finished chunks stay recorded for the next attempt
+                for future in futures:
+                    future.cancel()
+                raise
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.replace(part_name, file_name)
+    if os.path.exists(state_name):
+        os.remove(state_name)
+    return size
+
+
+def download_assets(node, uuid, folder, assets, workers=DOWNLOAD_WORKERS):
+    """
+    Downloads the given assets of the task into folder, in the layout of all.zip.
+    Returns the paths of the downloaded files.
+    """
+    unknown = [a for a in assets if a not in ASSET_PATHS]
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown assets {", ".join(unknown)}, known are {", ".join(ASSET_PATHS)}')
+
+    files = []
+    with session_for(workers) as session:
+        for asset in assets:
+            file_name = os.path.join(folder, ASSET_PATHS[asset])
+            start = time.perf_counter()
+            size = download_file(session, asset_url(node, uuid, asset), file_name, workers)
+            seconds = time.perf_counter() - start
+            logging.info('Downloaded %s (%.1f MB) in %.1fs', asset, size / 1e6, seconds)
+            files.append(file_name)
+    return files
+
+
+def download_task(node, uuid, folder, assets):
+    """
+    Downloads the listed assets of the task, or the complete all.zip if none are listed.
+    """
+    if len(assets) > 0:
+        return download_assets(node, uuid, folder, assets)
+    node.get_task(uuid).download_assets(folder)
+    return [folder]
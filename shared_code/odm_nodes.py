@@ -0,0 +1,174 @@
+"""
+Pool of NodeODM nodes the photogrammetry tasks are spread over, and the record of the
+node every task runs on (TASKS_FOLDER/<uuid>.json), so later calls reach the right node.
+
+NODEODM_NODES lists the nodes as comma separated host:port, optionally token@host:port.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from pyodm import Node
+
+from .manifest import write_json
+
+NODEODM_NODES = os.environ.get('NODEODM_NODES', 'nodeodm-sunshaine.azurewebsites.net:80')
+TASKS_FOLDER = os.environ.get('TASKS_FOLDER', '/datashare/tasks')
+# seconds a node may take to answer /info before it is left out of the scheduling
+NODE_INFO_TIMEOUT = 10
+# states of tasks that are done
+FINAL_STATES = ('downloaded', 'failed', 'canceled')
+TASKS_LOCK = '.lock'
+
+
+class NoNodeError(Exception):
+    pass
+
+
+def parse_nodes(config):
+    """
+    Returns the nodes of the configuration by key (host:port) as (host, port, token).
+    Tokens are not part of the key, so they are never written to the task records.
+    """
+    nodes = {}
+    for entry in config.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        token, _, address = entry.rpartition('@')
+        host, _, port = address.partition(':')
+        port = int(port) if port else 80
+        nodes[f'{host}:{port}'] = (host, port, token)
+    return nodes
+
+
+NODE_POOL = parse_nodes(NODEODM_NODES)
+
+# node clients of this worker process by key, reused between invocations
+_nodes = {}
+_nodes_lock = threading.Lock()
+
+
+def get_node(key, timeout=30):
+    with _nodes_lock:
+        if (key, timeout) not in _nodes:
+            host, port, token = NODE_POOL.get(key) or parse_nodes(key)[key]
+            _nodes[(key, timeout)] = Node(host, port, token, timeout=timeout)
+        return _nodes[(key, timeout)]
+
+
+def node_info(key):
+    try:
+        return get_node(key, NODE_INFO_TIMEOUT).info()
+    except Exception as e:
+        logging.warning('Node %s not available: %s', key, e)
+        return None
+
+
+def node_load(info):
+    """
+    Sort key of a node: queued tasks per task slot, then the most available memory.
+    """
+    slots = max(info.max_parallel_tasks or 1, 1)
+    return (info.task_queue_count or 0) / slots, -(info.available_memory or 0)
+
+
+def choose_node(num_images, keys=None):
+    """
+    Returns the key of the least loaded node able to take a task with num_images images,
+    asking all nodes of the pool for their live state in parallel.
+    """
+    keys = list(NODE_POOL) if keys is None else keys
+    with ThreadPoolExecutor(max_workers=max(len(keys), 1)) as pool:
+        infos = list(pool.map(node_info, keys))
+    candidates = [(node_load(info), key) for key, info in zip(keys, infos)
+                  if info is not None and (info.max_images is None or info.max_images >= num_images)]
+    if len(candidates) == 0:
+        raise NoNodeError(f'No node available for {num_images} images')
+    load, key = min(candidates)
+    logging.info('Scheduling %d images on node %s (load %.2f)', num_images, key, load[0])
+    return key
+
+
+def task_file(uuid):
+    if not uuid or os.path.basename(uuid) != uuid:
+        raise ValueError(f'Invalid task uuid {uuid!r}')
+    return os.path.join(TASKS_FOLDER, f'{uuid}.json')
+
+
+def load_task(uuid):
+    file_name = task_file(uuid)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'r') as f:
+        return json.load(f)
+
+
+def save_task(uuid, record):
+    os.makedirs(TASKS_FOLDER, exist_ok=True)
+    write_json(task_file(uuid), dict(record, uuid=uuid), indent=4)
+
+
+# updates of the task records by threads of this worker process
+_tasks_lock = threading.Lock()
+
+
+@contextmanager
+def tasks_locked():
+    """
+    Holds the lock of the task records, across the threads and processes of all workers.
+    """
+    os.makedirs(TASKS_FOLDER, exist_ok=True)
+    with _tasks_lock:
+        fd = os.open(os.path.join(TASKS_FOLDER, TASKS_LOCK), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing releases the lock
+            os.close(fd)
+
+
+def update_task(uuid, **fields):
+    """
+    Merges the fields into the record of the task as one atomic update. Once the task
+    is in a final state, e.g. failed by its upload, later updates do not change it,
+    except for a download, which shows the task completed after all.
+    """
+    with tasks_locked():
+        record = load_task(uuid) or {}
+        if record.get('state') in FINAL_STATES and fields.get('state') != 'downloaded':
+            fields.pop('state', None)
+        record.update(fields)
+        save_task(uuid, record)
+    return record
+
+
+def list_tasks():
+    """
+    Returns the records of all tasks.
+    """
+    if not os.path.isdir(TASKS_FOLDER):
+        return []
+    records = []
+    for file_name in sorted(os.listdir(TASKS_FOLDER)):
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(TASKS_FOLDER, file_name), 'r') as f:
+                    records.append(json.load(f))
+            except ValueError:
+                logging.warning('Unreadable task record %s', file_name)
+    return records
+
+
+def task_node(uuid):
+    """
+    Returns the client of the node the task runs on. Tasks without a record, created
+    before the node pool, are looked up on the first node of the pool.
+    """
+    record = load_task(uuid)
+    return get_node(record['node'] if record is not None else next(iter(NODE_POOL)))
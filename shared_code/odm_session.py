@@ -0,0 +1,17 @@
+"""
+HTTP sessions for the NodeODM API with a connection pool sized for the concurrent
+requests of a transfer, shared by the uploads and the downloads.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def session_for(workers):
+    """
+    Returns a session keeping up to workers connections to the node open for reuse.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,162 @@
+"""
+Creates NodeODM tasks with the chunked upload API: the task is initialised first, so its
+uuid is known right away, then the images are uploaded concurrently over pooled
+connections, one request per image with retries, and the task is committed.
+"""
+import io
+import logging
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from pyodm.utils import options_to_json
+
+from .odm_session import session_for
+
+UPLOAD_WORKERS = 8
+UPLOAD_RETRIES = 5
+# seconds to connect and to wait for the response of an upload
+UPLOAD_TIMEOUT = (10, 300)
+# images are re-encoded only when downscaled, with this JPEG quality
+DOWNSCALE_QUALITY = 95
+DOWNSCALE_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+class UploadError(Exception):
+    pass
+
+
+def check_result(response):
+    """
+    Returns the JSON result of a NodeODM call, raising UploadError for reported errors.
+    """
+    response.raise_for_status()
+    result = response.json()
+    if isinstance(result, dict) and 'error' in result:
+        raise UploadError(result['error'])
+    return result
+
+
+def downscale_image(file_name, max_size):
+    """
+    Returns the image as JPEG bytes with its longer side at most max_size, keeping the
+    EXIF data (GPS position, camera) ODM needs. Images already small enough and other
+    files are returned unchanged.
+    """
+    if max_size > 0 and file_name.lower().endswith(DOWNSCALE_EXTENSIONS):
+        from PIL import Image
+        with Image.open(file_name) as image:
+            if max(image.size) > max_size:
+                exif, icc = image.info.get('exif'), image.info.get('icc_profile')
+                image.thumbnail((max_size, max_size), Image.LANCZOS)
+                data = io.BytesIO()
+                image.save(data, format='JPEG', quality=DOWNSCALE_QUALITY,
+                           **{k: v for k, v in [('exif', exif), ('icc_profile', icc)] if v is not None})
+                return data.getvalue()
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def init_task(session, node, name, options):
+    """
+    Creates the task on the node without images and returns its uuid.
+    """
+    fields = {
+        'name': (None, name),
+        'options': (None, options_to_json(options)),
+    }
+    result = check_result(session.post(node.url('/task/new/init', {}), files=fields, timeout=UPLOAD_TIMEOUT))
+    return result['uuid']
+
+
+def upload_image(session, node, uuid, file_name, max_size=0, retries=UPLOAD_RETRIES):
+    """
+    Uploads one image to the initialised task, retrying with exponential backoff.
+    """
+    data = downscale_image(file_name, max_size)
+    mimetype = mimetypes.guess_type(file_name)[0] or 'image/jpg'
+    for attempt in range(retries):
+        try:
+            response = session.post(node.url(f'/task/new/upload/{uuid}', {}),
+                                    files={'images': (os.path.basename(file_name), data, mimetype)},
+                                    timeout=UPLOAD_TIMEOUT)
+            result = check_result(response)
+            if not result.get('success', False):
+                raise UploadError(f'Unexpected upload result {result}')
+            return len(data)
+        except (requests.RequestException, ValueError, UploadError) as e:
+            # the node rejects some files for good, e.g. unsupported types
+            no_retry = isinstance(e, requests.HTTPError) and e.response is not None \
+                and 400 <= e.response.status_code < 500
+            if no_retry or attempt == retries - 1:
+                raise UploadError(f'Upload of {file_name} failed: {e}') from e
+            logging.warning('Upload of %s failed (%s), retrying', file_name, e)
+            time.sleep(2 ** attempt)
+
+
+def commit_task(session, node, uuid):
+    check_result(session.post(node.url(f'/task/new/commit/{uuid}', {}), timeout=UPLOAD_TIMEOUT))
+
+
+def remove_task(session, node, uuid):
+    """
+    Removes a task whose upload failed, so it does not stay on the node uncommitted.
+    """
+    try:
+        check_result(session.post(node.url('/task/remove', {}), data={'uuid': uuid}, timeout=UPLOAD_TIMEOUT))
+    except (requests.RequestException, ValueError, UploadError):
+        logging.exception('Could not remove task %s', uuid)
+
+
+def upload_task(session, node, uuid, files, workers=UPLOAD_WORKERS, max_size=0):
+    """
+    Uploads all files concurrently and commits the task, which starts the processing.
+    The first failed upload cancels the ones not started yet.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(upload_image, session, node, uuid, f, max_size) for f in files]
+        try:
+            sizes = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    commit_task(session, node, uuid)
+    seconds = time.perf_counter() - start
+    logging.info('Task %s: uploaded %d files (%.1f MB) in %.1fs', uuid, len(files), sum(sizes) / 1e6, seconds)
+
+
+def start_task(node, files, options, name, workers=UPLOAD_WORKERS, max_size=0, on_done=None):
+    """
+    Initialises the task and returns its uuid right away, raising UploadError if the
+    node does not create it. The upload and the commit run in a background thread;
+    on_done(uuid, error) is called when they have finished, with error None on success.
+    """
+    if len(files) == 0:
+        raise UploadError('No images to upload')
+    session = session_for(workers)
+    try:
+        uuid = init_task(session, node, name, options)
+    except (requests.RequestException, ValueError, UploadError) as e:
+        session.close()
+        raise UploadError(f'Creating the task failed: {e}') from e
+
+    def run():
+        error = None
+        try:
+            upload_task(session, node, uuid, files, workers, max_size)
+        except Exception as e:
+            logging.exception('Upload of task %s failed', uuid)
+            remove_task(session, node, uuid)
+            error = e
+        finally:
+            session.close()
+        if on_done is not None:
+            on_done(uuid, error)
+
+    threading.Thread(target=run, name=f'upload-{uuid}', daemon=False).start()
+    return uuid
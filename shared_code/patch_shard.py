@@ -0,0 +1,85 @@
+import mmap
+import os
+
+import cv2
+import numpy as np
+
+# packed patches of one orthophoto: encoded patches appended back to back,
+# offsets and lengths are recorded per patch in mosaics.json
+PATCH_SHARD_SUFFIX = '.patches'
+
+
+def encode_patch(patch, ext='.png'):
+    ok, data = cv2.imencode(ext, patch)
+    if not ok:
+        raise ValueError(f'Could not encode patch as {ext}')
+    return data.tobytes()
+
+
+def decode_patch(data):
+    """
+    Decodes an encoded patch into a BGR uint8 array, same as cv2.imread.
+    """
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+class PatchShardWriter:
+    """
+    Appends encoded patches to a single shard file, so one file per orthophoto is
+    written to the share instead of one file per patch.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'wb')
+        self.offset = 0
+
+    def append(self, data):
+        offset = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+        return offset, len(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PatchShardReader:
+    """
+    Reads patches from a shard file by offset and length. The shard is memory-mapped,
+    if the file system does not support that ranged reads are used instead.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # empty shard or no mmap support on the mount
+            self.map = None
+
+    def read(self, offset, length):
+        if self.map is not None:
+            return self.map[offset:offset + length]
+        return os.pread(self.file.fileno(), length, offset)
+
+    def read_patch(self, offset, length):
+        return decode_patch(self.read(offset, length))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,51 @@
+"""
+Messages on process-queue. A job is either the plain uuid, processed by one MlProcess
+invocation, or split into shards of consecutive patches with one JSON message per shard:
+
+    {"uuid": ..., "run": ..., "shard": k, "shards": n, "start": ..., "end": ...}
+
+start and end index the patches in the order of mosaics.json. The results of the shards
+are collected in PROCESS_SHARDS_FOLDER/<run> in the patches folder until all are done.
+"""
+import json
+import uuid as uuidlib
+
+PROCESS_SHARDS_FOLDER = 'process-shards'
+# created exclusively by the shard that merges the results, so only one does
+FAN_IN_MARKER = 'fan-in'
+
+
+def shard_messages(uuid, num_patches, shard_patches):
+    """
+    Returns the process-queue messages for a job with num_patches patches, split into
+    shards of at most shard_patches patches. Jobs fitting into one shard, or with
+    shard_patches 0, get the plain uuid.
+    """
+    if shard_patches <= 0 or num_patches <= shard_patches:
+        return [uuid]
+    shards = -(-num_patches // shard_patches)
+    # spread the patches evenly, so no shard is much shorter than the others
+    size = -(-num_patches // shards)
+    run = uuidlib.uuid4().hex
+    return [json.dumps({
+        'uuid': uuid,
+        'run': run,
+        'shard': k,
+        'shards': shards,
+        'start': k * size,
+        'end': min((k + 1) * size, num_patches),
+    }) for k in range(shards)]
+
+
+def parse_message(body):
+    """
+    Returns the job of a process-queue message as dict, with only the uuid for plain messages.
+    """
+    body = body.strip()
+    if body.startswith('{'):
+        return json.loads(body)
+    return {'uuid': body}
+
+
+def shard_file(shard):
+    return f'shard{shard}.bin'
@@ -0,0 +1,85 @@
+"""
+Measures the cold start import time of every function of the app, each in a fresh
+Python process, and checks that non-inference functions do not import the heavy
+inference stack. Run from the app root:
+
+    python tools/check_cold_start.py [--repeat 3] [FUNCTION ...]
+
+Exits with 1 if a function exceeds its import time budget or imports a module it
+should not need.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import time budget in seconds
+BUDGETS = {
+    'MlProcess': 15.0,
+    'MlPreprocess': 3.0,
+    'MlPostprocess': 3.0,
+}
+DEFAULT_BUDGET = 1.5
+
+INFERENCE_MODULES = ['torch', 'torchvision', 'albumentations', 'onnxruntime']
+FORBIDDEN = {
+    'MlPreprocess': INFERENCE_MODULES,
+    'MlPostprocess': INFERENCE_MODULES + ['PIL'],
+    'PyOdmStart': INFERENCE_MODULES + ['cv2', 'osgeo'],
+    'PyOdmCheck': INFERENCE_MODULES + ['cv2', 'osgeo'],
+    'PyOdmDownload': INFERENCE_MODULES + ['cv2', 'osgeo'],
+}
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {function}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(m for m in sys.modules if '.' not in m)}}))
+'''
+
+
+def list_functions():
+    return sorted(os.path.basename(os.path.dirname(f))
+                  for f in glob.glob(os.path.join(ROOT, '*', 'function.json')))
+
+
+def measure(function):
+    result = subprocess.run([sys.executable, '-c', PROBE.format(function=function)],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else 'import failed')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the cold start import time of the functions.')
+    parser.add_argument('functions', nargs='*', help='functions to check, all by default')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh imports per function, the fastest counts')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for function in args.functions or list_functions():
+        budget = BUDGETS.get(function, DEFAULT_BUDGET)
+        try:
+            probes = [measure(function) for _ in range(max(1, args.repeat))]
+        except RuntimeError as e:
+            print(f'{function:16s} FAILED to import: {e}')
+            failed = True
+            continue
+        seconds = min(p['seconds'] for p in probes)
+        loaded = [m for m in FORBIDDEN.get(function, []) if m in probes[0]['modules']]
+        ok = seconds <= budget and not loaded
+        failed = failed or not ok
+        status = 'ok' if ok else 'FAILED'
+        extra = f", imports {', '.join(loaded)}" if loaded else ''
+        print(f'{function:16s} {seconds:6.2f}s (budget {budget:.1f}s){extra} {status}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
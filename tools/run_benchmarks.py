@@ -0,0 +1,285 @@
+"""
+Micro-benchmarks of the hot functions of the ML stages on synthetic inputs of growing
+size: mosaic megapixels, patch count or anomaly count. Every benchmark runs at three
+sizes and reports the best of several runs per size and the scaling exponent, the slope
+of time over size on a log-log scale (about 1 for linear, 2 for quadratic). Run from the
+app root:
+
+    python tools/run_benchmarks.py [--quick] [--repeat 3] [--json results.json]
+                                   [--baseline baseline.json] [--tolerance 1.25] [BENCHMARK ...]
+
+Needs the app's Python environment (GDAL, OpenCV, torch). Exits with 1 if a benchmark is
+slower than tolerance times the baseline at any size, or scales worse than the baseline.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from run_pipeline import write_orthophoto
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATCH_SIZE_HEIGHT = 512
+PATCH_SIZE_WIDTH = 640
+# points of the synthetic anomaly contours
+CONTOUR_POINTS = 8
+# anomalies per patch where the size is not the anomaly count
+ANOMALIES_PER_PATCH = 2
+# allowed increase of the scaling exponent over the baseline
+EXPONENT_TOLERANCE = 0.3
+
+
+def image_size(megapixels):
+    """
+    Width and height of an orthophoto of the given megapixels, in 4:3.
+    """
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    return width, width * 3 // 4
+
+
+def synthetic_anomalies(cols, rows, per_patch, seed=0):
+    """
+    Mosaic meta data of a cols x rows grid of patches, every tenth of them skipped, and
+    the columnar anomalies of the other patches in patch coordinates: per_patch anomalies
+    each, with one octagon contour. Returns (mosaic_meta, anomalies).
+    """
+    from shared_code.anomalies import _offsets
+
+    rng = np.random.default_rng(seed)
+    mosaic, names = [], []
+    for i in range(cols * rows):
+        patch = {
+            'patch_name': f'odm_orthophoto.tif-patch{i + 1}.png',
+            'x': (i % cols) * PATCH_SIZE_WIDTH,
+            'y': (i // cols) * PATCH_SIZE_HEIGHT,
+            'coverage': 1.0,
+        }
+        if i % 10 == 9:
+            patch['skipped'] = True
+        else:
+            names.append(patch['patch_name'])
+        mosaic.append(patch)
+
+    n = len(names) * per_patch
+    radius = rng.integers(4, 16, n)
+    centers = np.column_stack([rng.integers(20, PATCH_SIZE_WIDTH - 20, n),
+                               rng.integers(20, PATCH_SIZE_HEIGHT - 20, n)]).astype(np.int32)
+    angles = np.linspace(0, 2 * np.pi, CONTOUR_POINTS, endpoint=False)
+    octagon = np.column_stack([np.cos(angles), np.sin(angles)])
+    points = (centers[:, None, :] + radius[:, None, None] * octagon[None]).round().astype(np.int32)
+
+    anomalies = {
+        'boxes': np.concatenate([centers - radius[:, None], centers + radius[:, None]], axis=1).astype(np.int32),
+        'classes': rng.integers(1, 3, n).astype(np.int64),
+        'scores': rng.uniform(0.5, 1.0, n).astype(np.float32),
+        'centers': centers,
+        'contour_offsets': np.arange(n + 1, dtype=np.int64),
+        'point_offsets': np.arange(n + 1, dtype=np.int64) * CONTOUR_POINTS,
+        'points': points.reshape(-1, 2),
+        'patch_names': names,
+        'patch_offsets': _offsets(np.full(len(names), per_patch)),
+    }
+    return {'odm_orthophoto.tif': mosaic}, anomalies
+
+
+def synthetic_masks(count, seed=0):
+    """
+    Mask R-CNN style output for one patch: count soft masks (count, 1, H, W) with an
+    ellipse each and their boxes.
+    """
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((count, 1, PATCH_SIZE_HEIGHT, PATCH_SIZE_WIDTH), dtype=np.float32)
+    boxes = np.zeros((count, 4), dtype=np.float32)
+    for i in range(count):
+        cx, cy = int(rng.integers(30, PATCH_SIZE_WIDTH - 30)), int(rng.integers(30, PATCH_SIZE_HEIGHT - 30))
+        ax, ay = int(rng.integers(5, 30)), int(rng.integers(5, 30))
+        cv2.ellipse(masks[i, 0], (cx, cy), (ax, ay), float(rng.uniform(0, 180)), 0, 360, 0.9, -1)
+        # the ellipse is rotated, its box is the bounding box of the mask
+        x, y, w, h = cv2.boundingRect((masks[i, 0] >= 0.5).astype(np.uint8))
+        boxes[i] = (x, y, x + w, y + h)
+    return torch.from_numpy(masks), torch.from_numpy(boxes)
+
+
+def merged_anomalies(count):
+    """
+    Anomalies in mosaic coordinates, count of them spread over a square grid of patches.
+    """
+    from MlPostprocess import merge_anomalies
+    patches = max(1, count // ANOMALIES_PER_PATCH)
+    cols = math.ceil(math.sqrt(patches))
+    mosaic_meta, anomalies = synthetic_anomalies(cols, math.ceil(patches / cols), ANOMALIES_PER_PATCH)
+    return merge_anomalies(mosaic_meta, anomalies)
+
+
+# Every benchmark gets the size and a working folder, and returns the function to time.
+
+def bench_split_orthophoto(megapixels, folder):
+    from MlPreprocess import PATCHES_FOLDER, split_orthophoto
+    file_name = os.path.join(folder, 'odm_orthophoto.tif')
+    write_orthophoto(file_name, *image_size(megapixels), seed=0)
+    os.makedirs(os.path.join(folder, PATCHES_FOLDER))
+    return lambda: split_orthophoto(file_name, pool=None, store='png')
+
+
+def bench_masks_to_contour(anomalies, folder):
+    from MlProcess import masks_to_contour
+    masks, boxes = synthetic_masks(anomalies)
+    return lambda: masks_to_contour(masks, boxes)
+
+
+def bench_center_from_masks(anomalies, folder):
+    from MlProcess import center_from_masks
+    masks, boxes = synthetic_masks(anomalies)
+    return lambda: center_from_masks(masks, boxes)
+
+
+def bench_merge_anomalies(patches, folder):
+    from MlPostprocess import merge_anomalies
+    cols = math.ceil(math.sqrt(patches))
+    mosaic_meta, anomalies = synthetic_anomalies(cols, math.ceil(patches / cols), ANOMALIES_PER_PATCH)
+    return lambda: merge_anomalies(mosaic_meta, anomalies)
+
+
+def bench_add_gps_coords(anomalies, folder):
+    from MlPostprocess import add_gps_coords
+    file_name = os.path.join(folder, 'odm_orthophoto.tif')
+    write_orthophoto(file_name, PATCH_SIZE_WIDTH, PATCH_SIZE_HEIGHT, seed=0)
+    data = merged_anomalies(anomalies)
+    return lambda: add_gps_coords(file_name, dict(data))
+
+
+def bench_mark_anomalies(megapixels, folder):
+    from MlPostprocess import merge_anomalies, mark_anomalies
+    file_name = os.path.join(folder, 'odm_orthophoto.tif')
+    width, height = image_size(megapixels)
+    write_orthophoto(file_name, width, height, seed=0)
+    mosaic_meta, anomalies = synthetic_anomalies(max(1, width // PATCH_SIZE_WIDTH),
+                                                 max(1, height // PATCH_SIZE_HEIGHT), ANOMALIES_PER_PATCH)
+    data = merge_anomalies(mosaic_meta, anomalies)
+    return lambda: mark_anomalies(file_name, data)
+
+
+def bench_save_load_anomalies(anomalies, folder):
+    from MlPostprocess import ANOMALY_META, load_meta_data, save_anomalies
+    data = merged_anomalies(anomalies)
+
+    def run():
+        save_anomalies(folder, data)
+        loaded = load_meta_data(folder, ANOMALY_META)
+        # the columns are memory-mapped, touch them so they are actually read
+        return sum(int(np.asarray(column).view(np.uint8).sum())
+                   for column in loaded.values() if isinstance(column, np.ndarray))
+    return run
+
+
+# name: (function, size parameter, sizes, quick sizes)
+BENCHMARKS = {
+    'split_orthophoto': (bench_split_orthophoto, 'megapixels', [4, 16, 64], [0.5, 1, 2]),
+    'masks_to_contour': (bench_masks_to_contour, 'anomalies', [8, 32, 128], [4, 8, 16]),
+    'center_from_masks': (bench_center_from_masks, 'anomalies', [8, 32, 128], [4, 8, 16]),
+    'merge_anomalies': (bench_merge_anomalies, 'patches', [1000, 10000, 100000], [250, 1000, 4000]),
+    'add_gps_coords': (bench_add_gps_coords, 'anomalies', [1000, 10000, 100000], [250, 1000, 4000]),
+    'mark_anomalies': (bench_mark_anomalies, 'megapixels', [4, 16, 64], [0.5, 1, 2]),
+    'save_load_anomalies': (bench_save_load_anomalies, 'anomalies', [1000, 10000, 100000], [250, 1000, 4000]),
+}
+
+
+def scaling_exponent(sizes, seconds):
+    """
+    Least squares slope of log(seconds) over log(size).
+    """
+    x, y = np.log(np.asarray(sizes, dtype=np.float64)), np.log(np.maximum(seconds, 1e-9))
+    if len(x) < 2 or np.ptp(x) == 0:
+        return None
+    return float(np.polyfit(x, y, 1)[0])
+
+
+def run_benchmark(name, sizes, repeat):
+    function, parameter, _, _ = BENCHMARKS[name]
+    seconds = []
+    for size in sizes:
+        folder = tempfile.mkdtemp(prefix=f'bench-{name}-')
+        try:
+            run = function(size, folder)
+            run()  # warm up: imports, caches, first allocation
+            best = math.inf
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                best = min(best, time.perf_counter() - start)
+            seconds.append(best)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return {'parameter': parameter, 'sizes': list(sizes), 'seconds': seconds,
+            'exponent': scaling_exponent(sizes, seconds)}
+
+
+def compare(results, baseline, tolerance):
+    failed = []
+    for name, result in results.items():
+        reference = baseline.get('benchmarks', {}).get(name)
+        if reference is None:
+            continue
+        reference_seconds = dict(zip(reference['sizes'], reference['seconds']))
+        for size, seconds in zip(result['sizes'], result['seconds']):
+            if size in reference_seconds and seconds > tolerance * reference_seconds[size]:
+                failed.append(f"{name} at {size} {result['parameter']}: {seconds * 1e3:.1f}ms > "
+                              f"{tolerance:.2f} x {reference_seconds[size] * 1e3:.1f}ms")
+        if result['sizes'] == reference['sizes'] and None not in (result['exponent'], reference['exponent']) \
+                and result['exponent'] > reference['exponent'] + EXPONENT_TOLERANCE:
+            failed.append(f"{name} scales with exponent {result['exponent']:.2f}, "
+                          f"baseline {reference['exponent']:.2f}")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot functions of the ML stages.')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run, default all: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--quick', action='store_true', help='small sizes for a fast check')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per size, the best one counts')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed time factor over the baseline')
+    args = parser.parse_args(argv)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'Unknown benchmarks {", ".join(unknown)}')
+
+    sys.path.insert(0, ROOT)
+
+    results = {}
+    print(f"{'benchmark':20s} {'parameter':>10s} {'sizes':>24s} {'ms':>30s} {'exponent':>9s}")
+    for name in names:
+        _, _, sizes, quick_sizes = BENCHMARKS[name]
+        result = run_benchmark(name, quick_sizes if args.quick else sizes, max(1, args.repeat))
+        results[name] = result
+        exponent = '-' if result['exponent'] is None else f"{result['exponent']:.2f}"
+        print(f"{name:20s} {result['parameter']:>10s} {' '.join(f'{s:g}' for s in result['sizes']):>24s} "
+              f"{' '.join(f'{s * 1e3:.1f}' for s in result['seconds']):>30s} {exponent:>9s}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({'quick': args.quick, 'repeat': args.repeat, 'benchmarks': results}, indent=4))
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            failed = compare(results, json.load(f), args.tolerance)
+        for message in failed:
+            print(f'FAILED: {message}')
+        if failed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
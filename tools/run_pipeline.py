@@ -0,0 +1,336 @@
+"""
+Runs the ML stages of the app offline: MlPreprocess, MlProcess and MlPostprocess are
+driven through in-process queues standing in for the Azure Storage queues, on synthetic
+orthophotos and with a stub model that finds the hot spots drawn into them by
+thresholding. Like the Functions host, every stage runs in its own worker process,
+which serves all invocations of the stage and keeps its caches between them. Reports
+wall time, CPU time, the RSS of the worker after its imports and the peak RSS of the
+worker with its pool and loader processes per stage. Run from the app root:
+
+    python tools/run_pipeline.py [--width 8000] [--height 6000] [--jobs 1] [--json results.json]
+                                 [--baseline baseline.json] [--tolerance 1.25]
+
+Needs the app's Python environment (GDAL, OpenCV, torch) on Linux, but no storage
+account, model or datashare. Exits with 1 if a stage is slower than tolerance times
+the baseline.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# queue: (function, queue of its output binding)
+STAGES = {
+    'preprocess-queue': ('MlPreprocess', 'process-queue'),
+    'process-queue': ('MlProcess', 'postprocess-queue'),
+    'postprocess-queue': ('MlPostprocess', 'finished-queue'),
+}
+FINISHED_QUEUE = 'finished-queue'
+# 1 cm pixels in UTM zone 32N, like the drone orthophotos
+GEOTRANSFORM = (500000.0, 0.01, 0, 5300000.0, 0, -0.01)
+EPSG = 32632
+HOT_SPOTS_PER_MEGAPIXEL = 2
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+class LocalOut:
+    """
+    Output binding of a function: the messages it sets are passed on to the next queue.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def set(self, value):
+        self.messages = list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the resident set size of a process and all its descendants until stopped
+    and keeps the peak.
+    """
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = tree_rss(pid)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, tree_rss(self.pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, tree_rss(self.pid))
+        return self.peak
+
+
+def process_rss(pid):
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        # ended in the meantime
+        return 0
+
+
+def tree_rss(pid):
+    """
+    RSS of the process and its descendants, e.g. process pool and data loader workers.
+    """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat', 'r') as f:
+                    # the fields after the command name in parentheses: state, ppid, ...
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree, added = {pid}, True
+    while added:
+        children = {p for p, parent in parents.items() if parent in tree} - tree
+        tree |= children
+        added = len(children) > 0
+    return sum(process_rss(p) for p in tree)
+
+
+def cpu_seconds():
+    """
+    CPU time of this process and its finished child processes (pool and loader workers).
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class StageWorker:
+    """
+    Worker process of one stage, started with --worker. Takes the queue messages of the
+    stage on stdin and answers each with a JSON line holding the messages set on the
+    output binding and the wall and CPU time of the invocation.
+    """
+
+    def __init__(self, function):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', function],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        # the worker answers once it has imported the function
+        self.receive()
+        self.import_rss = tree_rss(self.process.pid)
+
+    def receive(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f'Worker exited with {self.process.wait()}')
+        return json.loads(line)
+
+    def invoke(self, body):
+        sampler = RssSampler(self.process.pid)
+        sampler.start()
+        try:
+            self.process.stdin.write(body + '\n')
+            self.process.stdin.flush()
+            result = self.receive()
+        finally:
+            result_peak = sampler.stop()
+        result['peak_rss'] = result_peak
+        return result
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def serve(function):
+    """
+    Worker side of StageWorker: calls the function's main for every message on stdin.
+    """
+    import azure.functions as func
+    # the protocol keeps stdout to itself, the stages print and log to stderr
+    protocol = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.path.insert(0, ROOT)
+    module = __import__(function)
+    protocol.write(json.dumps({'ready': True}) + '\n')
+    protocol.flush()
+    for line in sys.stdin:
+        out = LocalOut()
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        module.main(func.QueueMessage(body=line.rstrip('\n')), out)
+        wall, cpu = time.perf_counter() - wall, cpu_seconds() - cpu
+        protocol.write(json.dumps({'messages': out.messages, 'wall': wall, 'cpu': cpu}) + '\n')
+        protocol.flush()
+
+
+def write_orthophoto(file_name, width, height, seed):
+    """
+    Writes a synthetic RGBA orthophoto GeoTIFF: noisy background, rows of panels, hot
+    spots and a nodata border outside the surveyed area, written in strips.
+    """
+    from osgeo import gdal, osr
+    rng = np.random.default_rng(seed)
+    count = max(1, int(HOT_SPOTS_PER_MEGAPIXEL * width * height / 1e6))
+    spots = np.column_stack([rng.integers(0, width, count), rng.integers(0, height, count),
+                             rng.integers(3, 15, count)])
+
+    tif = gdal.GetDriverByName('GTiff').Create(file_name, width, height, 4, gdal.GDT_Byte,
+                                               options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    tif.SetGeoTransform(GEOTRANSFORM)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    tif.SetProjection(srs.ExportToWkt())
+    tif.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    strip = 512
+    border_x, border_y = width // 20, height // 20
+    for y in range(0, height, strip):
+        rows = min(strip, height - y)
+        grey = rng.normal(90, 12, (rows, width))
+        # panel rows every 2 m
+        grey[(np.arange(y, y + rows) % 200) < 120] += 40
+        grey = grey.clip(0, 255).astype(np.uint8)
+        in_strip = (spots[:, 1] + spots[:, 2] >= y) & (spots[:, 1] - spots[:, 2] < y + rows)
+        for cx, cy, r in spots[in_strip]:
+            cv2.circle(grey, (int(cx), int(cy - y)), int(r), 250, -1)
+        alpha = np.zeros((rows, width), dtype=np.uint8)
+        inside = (np.arange(y, y + rows) >= border_y) & (np.arange(y, y + rows) < height - border_y)
+        alpha[inside, border_x:width - border_x] = 255
+        for band in range(1, 4):
+            tif.GetRasterBand(band).WriteArray(np.where(alpha > 0, grey, 0), 0, y)
+        tif.GetRasterBand(4).WriteArray(alpha, 0, y)
+    tif.FlushCache()
+    tif = None
+    return count
+
+
+def prepare(root, jobs, width, height):
+    """
+    Creates the synthetic jobs in the downloads folder and the stub model, and points the
+    stages to them. Returns the uuids of the jobs.
+    """
+    downloads = os.path.join(root, 'downloads')
+    model_name = os.path.join(root, 'model', 'stub.model')
+    os.makedirs(os.path.dirname(model_name))
+    # imported here, so the workers of the stages without inference do not load torch
+    import torch
+    from stub_model import StubModel
+    torch.save(StubModel(), model_name)
+    os.environ['DOWNLOADS_FOLDER'] = downloads
+    os.environ['MODEL_NAME'] = model_name
+    os.environ.setdefault('INFERENCE_ENGINE', 'eager')
+
+    uuids = []
+    for job in range(jobs):
+        uuid = f'offline-{job:04d}'
+        folder = os.path.join(downloads, uuid, 'odm_orthophoto')
+        os.makedirs(folder)
+        write_orthophoto(os.path.join(folder, 'odm_orthophoto.tif'), width, height, seed=job)
+        uuids.append(uuid)
+    return uuids
+
+
+def run_pipeline(uuids):
+    """
+    Passes the uuids through the stages, sending the messages of each queue to the
+    worker of its stage. Returns the measurements per stage and the finished uuids.
+    """
+    queue = deque(('preprocess-queue', uuid) for uuid in uuids)
+    workers, stats, finished = {}, {}, []
+    try:
+        while queue:
+            queue_name, body = queue.popleft()
+            if queue_name == FINISHED_QUEUE:
+                finished.append(body)
+                continue
+            function, out_queue = STAGES[queue_name]
+            if function not in workers:
+                workers[function] = StageWorker(function)
+            m = workers[function].invoke(body)
+            stage = stats.setdefault(function, {'invocations': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                'import_rss': workers[function].import_rss, 'peak_rss': 0})
+            stage['invocations'] += 1
+            stage['wall'] += m['wall']
+            stage['cpu'] += m['cpu']
+            stage['peak_rss'] = max(stage['peak_rss'], m['peak_rss'])
+            queue.extend((out_queue, message) for message in m['messages'])
+    finally:
+        for worker in workers.values():
+            worker.close()
+    return stats, finished
+
+
+def compare(stats, baseline, tolerance):
+    failed = []
+    for function, stage in stats.items():
+        reference = baseline.get('stages', {}).get(function)
+        if reference is not None and stage['wall'] > tolerance * reference['wall']:
+            failed.append(f"{function} {stage['wall']:.2f}s > {tolerance:.2f} x {reference['wall']:.2f}s")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the ML stages offline on synthetic orthophotos.')
+    parser.add_argument('--width', type=int, default=8000, help='orthophoto width in pixels')
+    parser.add_argument('--height', type=int, default=6000, help='orthophoto height in pixels')
+    parser.add_argument('--jobs', type=int, default=1, help='number of jobs')
+    parser.add_argument('--json', help='write the measurements to this file')
+    parser.add_argument('--baseline', help='measurements of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed wall time factor over the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the working folder')
+    # started by StageWorker
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        serve(args.worker)
+        return 0
+
+    root = tempfile.mkdtemp(prefix='pipeline-')
+    try:
+        # the workers inherit the settings pointing the stages to the synthetic jobs
+        uuids = prepare(root, args.jobs, args.width, args.height)
+        stats, finished = run_pipeline(uuids)
+    finally:
+        if args.keep:
+            print(f'Working folder {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(f'{args.jobs} job(s) of {args.width}x{args.height} px, {len(finished)} finished')
+    print(f"{'stage':16s} {'calls':>5s} {'wall s':>8s} {'cpu s':>8s} {'import RSS MB':>14s} {'peak RSS MB':>12s}")
+    for function, stage in stats.items():
+        print(f"{function:16s} {stage['invocations']:5d} {stage['wall']:8.2f} {stage['cpu']:8.2f} "
+              f"{stage['import_rss'] / 1e6:14.1f} {stage['peak_rss'] / 1e6:12.1f}")
+
+    result = {'width': args.width, 'height': args.height, 'jobs': args.jobs, 'stages': stats}
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(result, indent=4))
+    if len(finished) != len(uuids):
+        print('FAILED: not all jobs finished')
+        return 1
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            failed = compare(stats, json.load(f), args.tolerance)
+        for message in failed:
+            print(f'FAILED: {message}')
+        if failed:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+Stub of the detection model for tools/run_pipeline.py. It lives in its own module, so the
+pickled model is loaded by the MlProcess worker without importing the pipeline runner.
+"""
+import torch
+
+
+class StubModel(torch.nn.Module):
+    """
+    Stands in for the Mask R-CNN model with the same output format: one detection per
+    patch covering all pixels brighter than the threshold.
+    """
+
+    def __init__(self, threshold=0.9):
+        super().__init__()
+        self.threshold = torch.nn.Parameter(torch.tensor(threshold), requires_grad=False)
+
+    def forward(self, images):
+        predictions = []
+        for image in images:
+            hot = image[0] > self.threshold
+            if not bool(hot.any()):
+                predictions.append({
+                    'boxes': torch.zeros((0, 4)),
+                    'labels': torch.zeros((0,), dtype=torch.int64),
+                    'scores': torch.zeros((0,)),
+                    'masks': torch.zeros((0, 1) + tuple(hot.shape)),
+                })
+                continue
+            ys, xs = torch.nonzero(hot, as_tuple=True)
+            box = torch.stack([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]).to(torch.float32)
+            predictions.append({
+                'boxes': box.reshape(1, 4),
+                'labels': torch.ones((1,), dtype=torch.int64),
+                'scores': torch.full((1,), 0.95),
+                'masks': hot.to(torch.float32)[None, None],
+            })
+        return predictions